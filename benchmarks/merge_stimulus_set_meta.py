@@ -0,0 +1,59 @@
+"""
+Compares the index-based `AssemblyLoader.merge_stimulus_set_meta` against the previous pandas-merge implementation
+on a synthetic assembly shaped like the objectome behavioral data (927,296 presentations).
+
+Run with `python benchmarks/merge_stimulus_set_meta.py`.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from brainio_base.stimuli import StimulusSet
+from brainio_collection.fetch import AssemblyLoader
+
+num_images, num_presentations, num_columns = 2400, 927_296, 20
+
+
+def stimulus_set():
+    random_state = np.random.RandomState(0)
+    stimuli = pd.DataFrame({'image_id': [f"image{i}" for i in range(num_images)]})
+    for column in range(num_columns):
+        stimuli[f"column{column}"] = random_state.rand(num_images) if column % 2 == 0 \
+            else random_state.choice(['a', 'b', 'c'], num_images)
+    return StimulusSet(stimuli)
+
+
+def assembly(stimuli):
+    random_state = np.random.RandomState(1)
+    image_ids = stimuli['image_id'].values[random_state.randint(0, num_images, num_presentations)]
+    return xr.DataArray(np.zeros((num_presentations, 1)), coords={
+        'image_id': ('presentation', image_ids),
+        'repetition': ('presentation', np.arange(num_presentations) % 10)}, dims=['presentation', 'choice'])
+
+
+def pandas_merge(assy, stimulus_set):
+    """ previous implementation, for reference """
+    axis_name, index_column = "presentation", "image_id"
+    df_of_coords = pd.DataFrame({name: coord.values for name, coord in assy.coords.items()
+                                 if coord.dims == (axis_name,)})
+    cols_to_use = stimulus_set.columns.difference(df_of_coords.columns.difference([index_column]))
+    merged = df_of_coords.merge(stimulus_set[cols_to_use], on=index_column, how="left")
+    for col in stimulus_set.columns:
+        assy[col] = (axis_name, merged[col])
+    return assy
+
+
+def main():
+    stimuli = stimulus_set()
+    loader = AssemblyLoader(local_path=None, stimulus_set_identifier='benchmark', cls='BehavioralAssembly')
+    for name, merge in [('pandas merge', pandas_merge), ('index join', loader.merge_stimulus_set_meta)]:
+        assy = assembly(stimuli)
+        start = time.perf_counter()
+        merge(assy, stimuli)
+        print(f"{name}: {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
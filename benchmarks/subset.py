@@ -0,0 +1,67 @@
+"""
+Compares `transform.subset` with the previous value-by-value membership test
+across source and target sizes, up to a behavioral-assembly-sized source (900,000 presentations).
+
+Run with `python benchmarks/subset.py`.
+"""
+import time
+
+import numpy as np
+import xarray as xr
+
+from brainio_collection.transform import subset, index_isin
+
+source_sizes, target_sizes = (10_000, 100_000, 900_000), (100, 1000, 3000)
+num_images = 10_000
+max_reference_size = 100_000  # the previous implementation takes minutes beyond this
+
+
+def membership_loop(source_values, target_values):
+    """ previous implementation, for reference """
+    indexer = np.array([val in target_values for val in source_values])
+    return np.where(indexer)[0]
+
+
+def assembly(num_presentations, random_state):
+    image_ids = np.array([f"image{i}" for i in random_state.randint(0, num_images, num_presentations)])
+    assy = xr.DataArray(np.zeros((num_presentations, 1)), coords={
+        'image_id': ('presentation', image_ids),
+        'repetition': ('presentation', np.arange(num_presentations) % 10),
+        'choice': ['a']}, dims=['presentation', 'choice'])
+    return assy.set_index(presentation=['image_id', 'repetition'])
+
+
+def target(num_images_target, random_state):
+    image_ids = np.array([f"image{i}" for i in random_state.choice(num_images, num_images_target, replace=False)])
+    assy = xr.DataArray(np.zeros(num_images_target), coords={
+        'image_id': ('presentation', image_ids),
+        'image_number': ('presentation', np.arange(num_images_target))}, dims=['presentation'])
+    return assy.set_index(presentation=['image_id', 'image_number'])
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    random_state = np.random.RandomState(0)
+    for source_size in source_sizes:
+        source = assembly(source_size, random_state)
+        for target_size in target_sizes:
+            target_assembly = target(target_size, random_state)
+            source_values, target_values = source['image_id'].values, target_assembly['image_id'].values
+            indexer, isin_time = timed(index_isin, source_values, target_values)
+            line = f"source {source_size:>7}, target {target_size:>4}: index_isin {isin_time:.3f} s"
+            if source_size <= max_reference_size:
+                reference, reference_time = timed(membership_loop, source_values, target_values)
+                np.testing.assert_array_equal(indexer, reference)
+                line += f", membership loop {reference_time:.3f} s"
+            _, subset_time = timed(subset, source, target_assembly, subset_dims=('presentation',),
+                                   dims_must_match=False)
+            print(line + f", subset {subset_time:.3f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,13 @@
-from .fetch import get_assembly, get_stimulus_set
 from .lookup import list_stimulus_sets
 from .lookup import list_assemblies
+
+
+def __getattr__(name):
+    # `fetch` pulls in xarray and pandas: only import it once data is actually requested
+    if name in ('get_assembly', 'get_stimulus_set'):
+        from . import fetch
+        return getattr(fetch, name)
+    if name == 'prefetch':
+        from .prefetching import prefetch
+        return prefetch
+    raise AttributeError(f"module {__name__} has no attribute {name}")
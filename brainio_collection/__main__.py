@@ -0,0 +1,3 @@
+from brainio_collection.cli import main
+
+main()
@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+_logger = logging.getLogger(__name__)
+
+_default_max_bytes = int(os.getenv('BRAINIO_ASSEMBLY_CACHE_BYTES', 2 * 2 ** 30))
+
+
+def assembly_nbytes(assembly):
+    """
+    Approximate in-memory size of an assembly: its data, all of its coordinates, and DataFrame attrs such as the
+    stimulus set. Object-dtype coordinates are only counted by their pointers.
+    """
+    return assembly.nbytes + sum(coord.nbytes for coord in assembly.coords.values()) + \
+        sum(int(value.memory_usage(deep=True).sum()) for value in assembly.attrs.values()
+            if isinstance(value, pd.DataFrame))
+
+
+class AssemblyCache:
+    """
+    A process-level least-recently-used cache of loaded assemblies, bounded by a total byte budget.
+    Entries are keyed by `(identifier, sha1)` so that a changed lookup entry never serves stale data.
+    Callers always receive a shallow copy of the cached assembly: the `attrs` dict, the stimulus set frame and the
+    coordinates are private to every caller, while the value, coordinate and stimulus set buffers are shared and
+    marked read-only, so that in-place modifications raise instead of changing what other callers see.
+    """
+
+    def __init__(self, max_bytes=_default_max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (assembly, nbytes)
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            assembly, _ = self._entries[key]
+        _logger.debug(f"Assembly cache hit for {key}")
+        return _view(assembly)
+
+    def put(self, key, assembly):
+        """
+        Stores the assembly under `key` if it fits into the byte budget, evicting least-recently-used entries.
+        :return: a view onto the cached assembly, or the assembly itself if it was too large to be cached
+        """
+        nbytes = assembly_nbytes(assembly)
+        if nbytes > self.max_bytes:
+            _logger.debug(f"Not caching {key}: {nbytes} bytes exceed cache budget of {self.max_bytes} bytes")
+            return assembly
+        assembly = assembly.load()  # lazily-loaded values would otherwise be re-read by every view
+        _make_read_only(assembly)
+        with self._lock:
+            if key in self._entries:
+                self._current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (assembly, nbytes)
+            self._current_bytes += nbytes
+            self._evict()
+        return _view(assembly)
+
+    def _evict(self):
+        while self._current_bytes > self.max_bytes and self._entries:
+            key, (_, nbytes) = self._entries.popitem(last=False)
+            self._current_bytes -= nbytes
+            self.evictions += 1
+            _logger.debug(f"Evicted {key} ({nbytes} bytes) from assembly cache")
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._current_bytes, 'max_bytes': self.max_bytes}
+
+
+def _make_read_only(assembly):
+    for variable in [assembly.variable] + [coord.variable for coord in assembly.coords.values()]:
+        if isinstance(variable.data, np.ndarray):
+            variable.data.flags.writeable = False
+    for value in assembly.attrs.values():
+        if isinstance(value, pd.DataFrame):
+            for block in value._mgr.blocks:
+                if isinstance(block.values, np.ndarray):
+                    block.values.flags.writeable = False
+
+
+def _view(assembly):
+    # shallow copies share the read-only numpy buffers of values, coordinates and stimulus set,
+    # so that a cache hit costs the same no matter how large the assembly and its stimulus set are
+    view = assembly.copy(deep=False)
+    view.attrs = {key: value.copy(deep=False) if isinstance(value, pd.DataFrame) else value
+                  for key, value in assembly.attrs.items()}
+    return view
@@ -0,0 +1,347 @@
+import atexit
+import contextlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from brainio_collection.locking import FileLock
+
+_logger = logging.getLogger(__name__)
+
+_default_root = os.path.expanduser(os.getenv('BRAINIO_HOME', '~/.brainio'))
+# byte quota for all artifacts in `BRAINIO_HOME`, enforced after every download. Unlimited if not set
+_default_max_bytes = int(os.getenv('BRAINIO_CACHE_MAX_BYTES')) if os.getenv('BRAINIO_CACHE_MAX_BYTES') else None
+_default_policy = os.getenv('BRAINIO_CACHE_POLICY', 'lru')
+# pins of processes on other hosts cannot be checked for liveness and are only honored for this long
+_foreign_pin_max_age = float(os.getenv('BRAINIO_CACHE_PIN_MAX_AGE_SECONDS', 24 * 60 * 60))
+# the access log is compacted once it grows beyond this size, also without a quota
+_max_access_log_bytes = int(os.getenv('BRAINIO_CACHE_ACCESS_LOG_MAX_BYTES', 2 ** 20))
+
+ACCESS_LOG_FILENAME = '.access_log'
+PINS_DIRECTORY = '.pins'
+BLOBS_DIRECTORY = '.blobs'  # content-addressed files that the files in artifacts are linked to
+POLICIES = ('lru', 'lfu')
+
+SCANNED_COMPONENT = '*'  # size of a whole artifact from scanning it, replaces all previously recorded sizes
+
+_lifetime_pins = set()  # pin files of this process that are kept until it exits
+_pin_counts = {}  # pin file -> number of active `pinned` contexts in this process
+_own_pins_lock = threading.Lock()
+
+
+class DiskCache:
+    """
+    Size and access bookkeeping for the artifacts in `BRAINIO_HOME`, with eviction down to a byte quota.
+    An artifact is one top-level directory: the downloaded file together with everything derived from it,
+    such as extracted images and memory-mapped stores. Directories starting with '.' hold bookkeeping and are ignored.
+    Accesses and the sizes of an artifact's components (the downloaded file, extracted images, ...) are appended to a
+    log when they are created, so that sizes are known without walking the artifacts' files. Only artifacts without
+    recorded sizes, e.g. from before the log existed, are scanned once.
+    The log is compacted when pruning, and whenever it grows beyond `BRAINIO_CACHE_ACCESS_LOG_MAX_BYTES`.
+    Artifacts that a live process is using are pinned and never evicted: `brainio_collection` pins artifacts while
+    fetching them, and until the process exits once their data was handed out, since values and images are read
+    from them lazily.
+    Blobs that are no longer linked from any artifact are removed when pruning.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or _default_root
+        self.access_log_path = os.path.join(self.root, ACCESS_LOG_FILENAME)
+        self.pins_path = os.path.join(self.root, PINS_DIRECTORY)
+
+    def record_access(self, name, hit):
+        """
+        :param hit: whether the artifact was already present locally
+        """
+        log_size = self._append({'name': name, 'time': time.time(), 'hits': int(hit), 'misses': int(not hit)})
+        if log_size > _max_access_log_bytes:
+            with FileLock(os.path.join(self.root, '.locks', 'cache.lock')):
+                if os.path.getsize(self.access_log_path) > _max_access_log_bytes:  # not yet compacted by others
+                    self._compact_access_log()
+
+    def record_size(self, name, component, size):
+        """
+        Records the size of one component of an artifact, replacing the component's previously recorded size.
+        :param component: e.g. the name of the downloaded file, or 'extracted' for the images extracted from it
+        """
+        self._append({'name': name, 'component': component, 'size': size})
+
+    def _append(self, entry):
+        """
+        :return: the size of the log after appending
+        """
+        return self._append_bytes((json.dumps(entry) + '\n').encode())
+
+    def _append_bytes(self, data):
+        os.makedirs(self.root, exist_ok=True)
+        file_descriptor = os.open(self.access_log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(file_descriptor, data)
+            return os.fstat(file_descriptor).st_size
+        finally:
+            os.close(file_descriptor)
+
+    def pin(self, name):
+        """
+        Pins the artifact until this process exits, e.g. while values or images are still read from it lazily.
+        """
+        pin_path = self._own_pin_path(name)
+        with _own_pins_lock:
+            if pin_path not in _lifetime_pins and not _pin_counts.get(pin_path):
+                _create_pin(pin_path)
+            _lifetime_pins.add(pin_path)
+
+    @contextlib.contextmanager
+    def pinned(self, name):
+        """
+        Pins the artifact for the duration of the context. Contexts can be nested, also across threads.
+        """
+        pin_path = self._own_pin_path(name)
+        with _own_pins_lock:
+            if pin_path not in _lifetime_pins and not _pin_counts.get(pin_path):
+                _create_pin(pin_path)
+            _pin_counts[pin_path] = _pin_counts.get(pin_path, 0) + 1
+        try:
+            yield
+        finally:
+            with _own_pins_lock:
+                _pin_counts[pin_path] -= 1
+                if not _pin_counts[pin_path]:
+                    del _pin_counts[pin_path]
+                    if pin_path not in _lifetime_pins:
+                        _remove_quietly(pin_path)
+
+    def _own_pin_path(self, name):
+        return os.path.join(self.pins_path, name, f"{socket.gethostname()}-{os.getpid()}")
+
+    def is_pinned(self, name):
+        try:
+            pins = os.listdir(os.path.join(self.pins_path, name))
+        except FileNotFoundError:
+            return False
+        hostname = socket.gethostname()
+        for pin in pins:
+            host, _, pid = pin.rpartition('-')
+            pin_path = os.path.join(self.pins_path, name, pin)
+            if host == hostname:
+                if _is_alive(int(pid)):
+                    return True
+                _remove_quietly(pin_path)  # left behind by a process that crashed
+            else:
+                try:
+                    if time.time() - os.stat(pin_path).st_mtime < _foreign_pin_max_age:
+                        return True
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def access_stats(self):
+        """
+        :return: `{name: {'last_access': timestamp, 'hits': count, 'misses': count, 'sizes': {component: bytes}}}`
+            from the access log
+        """
+        try:
+            with open(self.access_log_path, 'rb') as f:
+                return _parse_access_log(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def artifacts(self):
+        """
+        :return: a list of dicts with each artifact's `name`, `size` in bytes, `last_access`, `hits`, `misses`
+            and whether it is `pinned`. Artifacts without recorded accesses use their modification time.
+            Only the top level of the cache directory is listed: sizes come from the log.
+        """
+        stats = self.access_stats()
+        artifacts = []
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return artifacts
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+                continue
+            artifact_stats = dict(stats.get(entry.name, {'last_access': 0, 'hits': 0, 'misses': 0, 'sizes': {}}))
+            sizes = artifact_stats.pop('sizes')
+            if not sizes:  # never recorded, scan once
+                sizes = {SCANNED_COMPONENT: directory_size(entry.path)}
+                self.record_size(entry.name, SCANNED_COMPONENT, sizes[SCANNED_COMPONENT])
+            if not artifact_stats['last_access']:
+                artifact_stats['last_access'] = entry.stat().st_mtime
+            artifacts.append(dict(name=entry.name, size=sum(sizes.values()), pinned=self.is_pinned(entry.name),
+                                  **artifact_stats))
+        return artifacts
+
+    def total_size(self):
+        return sum(artifact['size'] for artifact in self.artifacts())
+
+    def prune(self, max_bytes, policy=None, dry_run=False):
+        """
+        Evicts unpinned artifacts until all artifacts together take up at most `max_bytes`.
+        :param policy: 'lru' to evict the least recently used artifacts first,
+            'lfu' to evict the least frequently used first. Defaults to the `BRAINIO_CACHE_POLICY` environment
+            variable or 'lru'.
+        :param dry_run: only report which artifacts would be evicted
+        :return: the artifacts (see `artifacts`) that were evicted
+        """
+        policy = policy or _default_policy
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy {policy}, choose one of {POLICIES}")
+        with FileLock(os.path.join(self.root, '.locks', 'cache.lock')):
+            artifacts = self.artifacts()
+            total_size = sum(artifact['size'] for artifact in artifacts)
+            if policy == 'lru':
+                order = sorted(artifacts, key=lambda artifact: artifact['last_access'])
+            else:
+                order = sorted(artifacts, key=lambda artifact: (artifact['hits'] + artifact['misses'],
+                                                                artifact['last_access']))
+            evicted = []
+            for artifact in order:
+                if total_size <= max_bytes:
+                    break
+                if artifact['pinned']:
+                    continue
+                if not dry_run:
+                    self._evict(artifact['name'])
+                total_size -= artifact['size']
+                evicted.append(artifact)
+            if not dry_run:
+                self._compact_access_log()
+                self._remove_unlinked_blobs()
+        if total_size > max_bytes:
+            _logger.warning(f"{self.root} takes up {total_size} bytes after pruning, more than the quota of "
+                            f"{max_bytes} bytes, because the remaining artifacts are pinned")
+        return evicted
+
+    def _evict(self, name):
+        if self.is_pinned(name):  # pinned since listing the artifacts
+            return
+        _logger.info(f"Evicting {name} from {self.root}")
+        # move out of the way atomically so that no process sees a partially deleted artifact
+        evicting_path = os.path.join(self.root, f".evicting-{name}-{uuid.uuid4().hex}")
+        os.rename(os.path.join(self.root, name), evicting_path)
+        shutil.rmtree(evicting_path, ignore_errors=True)
+
+    def _remove_unlinked_blobs(self):
+        for directory in _scandir_quietly(os.path.join(self.root, BLOBS_DIRECTORY)):
+            for entry in _scandir_quietly(directory.path):
+                if entry.is_symlink():
+                    unlinked = not os.path.exists(entry.path)  # points to a file of an evicted artifact
+                else:
+                    unlinked = entry.stat().st_nlink <= 1  # no artifact hard links to it anymore
+                if unlinked:
+                    _logger.debug(f"Removing unlinked blob {entry.path}")
+                    _remove_quietly(entry.path)
+
+    def _compact_access_log(self):
+        """
+        Rewrites the log with one access summary and one line per component size for every artifact that still exists.
+        Must be called with the cache lock held. Lines appended by other processes meanwhile are carried over.
+        """
+        try:
+            old_log = open(self.access_log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with old_log:
+            self._write_compacted(_parse_access_log(old_log.read()))
+            carried_over = old_log.read()
+        if carried_over:
+            self._append_bytes(carried_over)
+
+    def _write_compacted(self, stats):
+        existing = {entry.name for entry in os.scandir(self.root)}
+        temp_path = f"{self.access_log_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            for name, artifact_stats in stats.items():
+                if name not in existing:
+                    continue
+                if artifact_stats['last_access']:
+                    f.write(json.dumps({'name': name, 'time': artifact_stats['last_access'],
+                                        'hits': artifact_stats['hits'], 'misses': artifact_stats['misses']}) + '\n')
+                for component, size in artifact_stats['sizes'].items():
+                    f.write(json.dumps({'name': name, 'component': component, 'size': size}) + '\n')
+        os.replace(temp_path, self.access_log_path)
+
+
+def enforce_quota(cache, max_bytes=None):
+    """
+    Prunes the cache down to `max_bytes`, or the `BRAINIO_CACHE_MAX_BYTES` environment variable if not given.
+    Does nothing without a quota, or if the recorded sizes are within it.
+    """
+    max_bytes = max_bytes or _default_max_bytes
+    if max_bytes is None or cache.total_size() <= max_bytes:  # checked without the cache lock
+        return []
+    return cache.prune(max_bytes)
+
+
+def directory_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += directory_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):  # symlinked files do not take up space here
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+def _parse_access_log(data):
+    stats = {}
+    for line in data.decode().splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # torn line of a crashed writer
+        artifact_stats = stats.setdefault(entry['name'], {'last_access': 0, 'hits': 0, 'misses': 0, 'sizes': {}})
+        if 'component' in entry:
+            if entry['component'] == SCANNED_COMPONENT:
+                artifact_stats['sizes'].clear()
+            artifact_stats['sizes'][entry['component']] = entry['size']
+            continue
+        artifact_stats['last_access'] = max(artifact_stats['last_access'], entry['time'])
+        artifact_stats['hits'] += entry['hits']
+        artifact_stats['misses'] += entry['misses']
+    return stats
+
+
+def _create_pin(pin_path):
+    os.makedirs(os.path.dirname(pin_path), exist_ok=True)
+    with open(pin_path, 'w'):
+        pass
+
+
+def _scandir_quietly(path):
+    try:
+        return list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but belongs to another user
+        return True
+    return True
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@atexit.register
+def _remove_own_pins():
+    with _own_pins_lock:
+        for pin_path in _lifetime_pins | set(_pin_counts):
+            _remove_quietly(pin_path)
+        _lifetime_pins.clear()
+        _pin_counts.clear()
@@ -0,0 +1,70 @@
+import argparse
+import datetime
+
+from brainio_collection import lookup
+from brainio_collection.cache_manager import POLICIES, DiskCache
+
+
+def lookup_compact(args):
+    lookup.catalog.compact()
+
+
+def lookup_export(args):
+    lookup.catalog.export(args.csv_path)
+
+
+def cache_list(args):
+    artifacts = sorted(DiskCache(args.root).artifacts(), key=lambda artifact: artifact['last_access'], reverse=True)
+    for artifact in artifacts:
+        last_access = datetime.datetime.fromtimestamp(artifact['last_access']).isoformat(sep=' ', timespec='seconds')
+        print(f"{artifact['size']:>14} {last_access} {artifact['hits']:>6} hits {artifact['misses']:>4} misses "
+              f"{'pinned' if artifact['pinned'] else '      '} {artifact['name']}")
+
+
+def cache_prune(args):
+    evicted = DiskCache(args.root).prune(args.max_bytes, policy=args.policy, dry_run=args.dry_run)
+    for artifact in evicted:
+        print(f"{'Would evict' if args.dry_run else 'Evicted'} {artifact['name']} ({artifact['size']} bytes)")
+    print(f"{len(evicted)} artifacts, {sum(artifact['size'] for artifact in evicted)} bytes")
+
+
+def cache_stats(args):
+    artifacts = DiskCache(args.root).artifacts()
+    hits = sum(artifact['hits'] for artifact in artifacts)
+    accesses = hits + sum(artifact['misses'] for artifact in artifacts)
+    print(f"{len(artifacts)} artifacts, {sum(artifact['size'] for artifact in artifacts)} bytes, "
+          f"{sum(artifact['pinned'] for artifact in artifacts)} pinned")
+    print(f"{accesses} accesses, hit rate {hits / accesses if accesses else 0:.1%}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='brainio', description="BrainIO collection maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    lookup_parser = subparsers.add_parser('lookup', help="maintain the lookup catalog")
+    lookup_subparsers = lookup_parser.add_subparsers(dest='lookup_command', required=True)
+    compact_parser = lookup_subparsers.add_parser('compact', help="fold the journal into the lookup csv file")
+    compact_parser.set_defaults(function=lookup_compact)
+    export_parser = lookup_subparsers.add_parser('export', help="write all lookup rows to a csv file")
+    export_parser.add_argument('csv_path')
+    export_parser.set_defaults(function=lookup_export)
+
+    cache_parser = subparsers.add_parser('cache', help="inspect and prune the local files in BRAINIO_HOME")
+    cache_parser.add_argument('--root', default=None, help="cache directory, defaults to BRAINIO_HOME")
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    list_parser = cache_subparsers.add_parser('list', help="list artifacts by recency with their size and accesses")
+    list_parser.set_defaults(function=cache_list)
+    prune_parser = cache_subparsers.add_parser('prune', help="evict unpinned artifacts down to a byte quota")
+    prune_parser.add_argument('max_bytes', type=int)
+    prune_parser.add_argument('--policy', choices=POLICIES, default=None,
+                              help="eviction order, defaults to BRAINIO_CACHE_POLICY or lru")
+    prune_parser.add_argument('--dry-run', action='store_true', help="only list what would be evicted")
+    prune_parser.set_defaults(function=cache_prune)
+    stats_parser = cache_subparsers.add_parser('stats', help="show the total size and hit rate")
+    stats_parser.set_defaults(function=cache_stats)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.function(args)
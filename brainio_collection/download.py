@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import boto3
+import requests
+from botocore import UNSIGNED
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from brainio_collection.files import read_json, write_json_atomic
+
+_logger = logging.getLogger(__name__)
+
+_default_part_size = int(os.getenv('BRAINIO_DOWNLOAD_PART_SIZE', 8 * 2 ** 20))
+_default_max_concurrency = int(os.getenv('BRAINIO_DOWNLOAD_CONCURRENCY', 8))
+_part_retries = 3
+
+PARTIAL_SUFFIX = '.partial'
+MANIFEST_SUFFIX = '.partial.json'
+
+# (signed, endpoint url) -> boto3 client, shared across downloads. Clients (unlike resources) are thread-safe
+_clients = {}
+_bucket_signed = {}  # (endpoint url, bucket name) -> whether signed requests worked for this bucket
+_clients_lock = threading.Lock()
+_http_session = None  # shared so that connections to the same host are kept alive and re-used
+
+
+def s3_client(signed, endpoint_url=None):
+    """
+    :param endpoint_url: the url of an S3-compatible object store, or None for AWS S3
+    """
+    with _clients_lock:
+        if (signed, endpoint_url) not in _clients:
+            config = Config(max_pool_connections=max(10, _default_max_concurrency))
+            if not signed:
+                # disable signing requests. see https://stackoverflow.com/a/34866092/2225200
+                config = config.merge(Config(signature_version=UNSIGNED))
+            _clients[(signed, endpoint_url)] = boto3.client('s3', config=config, endpoint_url=endpoint_url)
+        return _clients[(signed, endpoint_url)]
+
+
+def head_object(bucket, key, endpoint_url=None):
+    """
+    Retrieves the object's metadata, trying the access mode that last worked for this bucket first.
+    Without a known access mode, signed access is attempted before unsigned access.
+    :return: the client that could access the object, and the object's metadata
+    """
+    signing_modes = [True, False]
+    if (endpoint_url, bucket) in _bucket_signed:
+        signing_modes.sort(key=lambda signed: signed != _bucket_signed[(endpoint_url, bucket)])
+    errors = []
+    for signed in signing_modes:
+        client = s3_client(signed, endpoint_url=endpoint_url)
+        try:
+            head = client.head_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            _logger.debug(f"{'signed' if signed else 'unsigned'} access to {bucket}/{key} failed: {e}")
+            errors.append(e)
+            continue
+        _bucket_signed[(endpoint_url, bucket)] = signed
+        return client, head
+    # raise Exception instead of specific type to avoid missing __init__ arguments
+    raise Exception(errors)
+
+
+def download_s3_object(bucket, key, output_filename, sha1=None, part_size=None, max_concurrency=None,
+                       endpoint_url=None):
+    """
+    Downloads an S3 object by fetching byte ranges concurrently and writing them into a preallocated file.
+    Parts are hashed in order as they arrive so that the file does not need to be re-read for verification.
+    The download is written to `<output_filename>.partial`, alongside a manifest of completed parts so that an
+    interrupted download can be resumed. Only once the hash matches is the file moved to `output_filename`.
+    :param sha1: the expected SHA-1 hash of the object. If None, the file is moved into place without verification.
+    :param part_size: size of each ranged request in bytes.
+        Defaults to the `BRAINIO_DOWNLOAD_PART_SIZE` environment variable or 8 MiB.
+    :param max_concurrency: number of parallel ranged requests.
+        Defaults to the `BRAINIO_DOWNLOAD_CONCURRENCY` environment variable or 8.
+    :param endpoint_url: the url of an S3-compatible object store to download from instead of AWS S3
+    :return: the SHA-1 hash of the downloaded file
+    """
+    max_concurrency = max_concurrency or _default_max_concurrency
+    client, head = head_object(bucket, key, endpoint_url=endpoint_url)
+    size, etag = head['ContentLength'], head.get('ETag')
+    partial_filename, manifest_filename = output_filename + PARTIAL_SUFFIX, output_filename + MANIFEST_SUFFIX
+    manifest = read_json(manifest_filename, default={})
+    if os.path.isfile(partial_filename) and manifest.get('etag') == etag and manifest.get('size') == size:
+        part_size = manifest['part_size']  # parts must line up with the ones already on disk
+        completed_parts = set(manifest['completed_parts'])
+        _logger.debug(f"Resuming download of {bucket}/{key}: {len(completed_parts)} parts already complete")
+    else:
+        part_size = part_size or _default_part_size
+        completed_parts = set()
+        with open(partial_filename, 'wb') as partial_file:
+            partial_file.truncate(size)
+    manifest = {'etag': etag, 'size': size, 'part_size': part_size, 'completed_parts': sorted(completed_parts)}
+    write_json_atomic(manifest_filename, manifest)
+
+    parts = [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+    remaining_parts = iter([part_number for part_number in range(len(parts)) if part_number not in completed_parts])
+    hasher = hashlib.sha1()
+    with open(partial_filename, 'r+b') as partial_file, \
+            tqdm(total=size, initial=sum(parts[part_number][1] for part_number in completed_parts),
+                 unit='B', unit_scale=True, desc=f"{bucket}/{key}") as progress_bar, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = {}  # future -> part number
+        received = {}  # part number -> data, waiting to be hashed in order
+        next_hash = 0
+        while next_hash < len(parts):
+            # feed all parts that are available in order into the hash
+            while next_hash < len(parts) and (next_hash in received or next_hash in completed_parts):
+                if next_hash in received:
+                    hasher.update(received.pop(next_hash))
+                else:  # part from a previous attempt
+                    offset, length = parts[next_hash]
+                    partial_file.seek(offset)
+                    hasher.update(partial_file.read(length))
+                next_hash += 1
+            if next_hash == len(parts):
+                break
+            # bound the number of parts held in memory while earlier parts are still outstanding
+            while len(pending) + len(received) < 2 * max_concurrency:
+                part_number = next(remaining_parts, None)
+                if part_number is None:
+                    break
+                offset, length = parts[part_number]
+                future = executor.submit(_get_range, client, bucket, key, offset, length, etag=etag)
+                pending[future] = part_number
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                part_number = pending.pop(future)
+                data = future.result()
+                partial_file.seek(parts[part_number][0])
+                partial_file.write(data)
+                progress_bar.update(len(data))
+                received[part_number] = data
+                completed_parts.add(part_number)
+            partial_file.flush()  # only record parts in the manifest once they were handed to the OS
+            manifest['completed_parts'] = sorted(completed_parts)
+            write_json_atomic(manifest_filename, manifest)
+    actual_sha1 = hasher.hexdigest()
+    if sha1 is not None and actual_sha1 != sha1:
+        os.remove(partial_filename)
+        os.remove(manifest_filename)
+        raise IOError(f"Download of {bucket}/{key}: invalid SHA-1 hash {actual_sha1} (expected {sha1})")
+    os.replace(partial_filename, output_filename)
+    os.remove(manifest_filename)
+    return actual_sha1
+
+
+def _get_range(client, bucket, key, offset, length, etag=None):
+    byte_range = f"bytes={offset}-{offset + length - 1}"
+    kwargs = {'IfMatch': etag} if etag else {}  # make sure all parts come from the same version of the object
+    for attempt in range(_part_retries):
+        try:
+            data = client.get_object(Bucket=bucket, Key=key, Range=byte_range, **kwargs)['Body'].read()
+            if len(data) != length:
+                raise IOError(f"Received {len(data)} bytes for range {byte_range} of {bucket}/{key}")
+            return data
+        except Exception:
+            if attempt == _part_retries - 1:
+                raise
+            _logger.debug(f"Retrying range {byte_range} of {bucket}/{key}", exc_info=True)
+
+
+def http_session():
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max(10, _default_max_concurrency),
+                                  pool_maxsize=max(10, _default_max_concurrency), max_retries=_part_retries)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def download_http(url, output_filename, sha1=None, chunk_size=2 ** 20):
+    """
+    Downloads a file over HTTP(S) with the shared, connection-pooling session, hashing it while it is written.
+    The download is written to `<output_filename>.partial` and only moved to `output_filename` once the hash matches.
+    :param sha1: the expected SHA-1 hash of the file. If None, the file is moved into place without verification.
+    :return: the SHA-1 hash of the downloaded file
+    """
+    partial_filename = output_filename + PARTIAL_SUFFIX
+    hasher = hashlib.sha1()
+    with http_session().get(url, stream=True) as response:
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length', 0)) or None
+        with open(partial_filename, 'wb') as partial_file, \
+                tqdm(total=size, unit='B', unit_scale=True, desc=url) as progress_bar:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                partial_file.write(chunk)
+                hasher.update(chunk)
+                progress_bar.update(len(chunk))
+    actual_sha1 = hasher.hexdigest()
+    if sha1 is not None and actual_sha1 != sha1:
+        os.remove(partial_filename)
+        raise IOError(f"Download of {url}: invalid SHA-1 hash {actual_sha1} (expected {sha1})")
+    os.replace(partial_filename, output_filename)
+    return actual_sha1
@@ -2,34 +2,71 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import os
+import shutil
+import threading
+import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+import numpy as np
 import pandas as pd
 import xarray as xr
-from botocore import UNSIGNED
-from botocore.config import Config
 from six.moves.urllib.parse import urlparse
-from tqdm import tqdm
+from six.moves.urllib.request import url2pathname
 
 from brainio_base import assemblies as assemblies_base
-from brainio_base.assemblies import coords_for_dim
 from brainio_base.stimuli import StimulusSet
+from brainio_collection.assembly_cache import AssemblyCache
+from brainio_collection.cache_manager import BLOBS_DIRECTORY, DiskCache, directory_size, enforce_quota
+from brainio_collection.download import download_http, download_s3_object
+from brainio_collection.files import read_json, write_json_atomic
+from brainio_collection.image_paths import ImagePaths
+from brainio_collection.locking import FileLock
 from brainio_collection.lookup import lookup_assembly, lookup_stimulus_set, sha1_hash
+from brainio_collection.memmap_store import memmap_store_path, open_memmap_store, write_memmap_store
+from brainio_collection.metadata_sidecar import SIDECAR_SUFFIX, feather, read_metadata, sidecar_path
+from brainio_collection.stimulus_set_meta import stimulus_set_index
+from brainio_collection.verification import VerificationIndex, file_identity
+from brainio_collection.zip_store import ZipImageStore
 
 _local_data_path = os.path.expanduser(os.getenv('BRAINIO_HOME', '~/.brainio'))
+# re-hash every file on access instead of trusting the verification index
+_strict_verification = os.getenv('BRAINIO_STRICT_VERIFICATION', '0') == '1'
+# how assembly values are read: 'netcdf' to decode the downloaded file, 'memmap' to memory-map a raw copy of it
+_default_assembly_backend = os.getenv('BRAINIO_ASSEMBLY_BACKEND', 'netcdf')
+# serve repeated `get_assembly` calls from the in-process `assembly_cache`
+_default_use_cache = os.getenv('BRAINIO_ASSEMBLY_CACHE', '0') == '1'
+_default_extract_concurrency = int(os.getenv('BRAINIO_EXTRACT_CONCURRENCY', 8))
+
+EXTRACTION_MANIFEST_SUFFIX = '.extracted.json'
+SHA1_PREFIX_LENGTH = 12
 
 _logger = logging.getLogger(__name__)
 
+assembly_cache = AssemblyCache()
+verification_index = VerificationIndex(os.path.join(_local_data_path, '.sha1_index.json'))
+
+
+def artifact_lock(path):
+    """
+    Cross-process lock for a file or directory in the local data path, shared by all processes using the same
+    `BRAINIO_HOME`. Lock files are kept separately so they do not show up in stimulus directories.
+    """
+    name = os.path.relpath(os.path.abspath(path), os.path.abspath(_local_data_path)).replace(os.sep, '__')
+    return FileLock(os.path.join(_local_data_path, '.locks', name + '.lock'))
+
 
 class Fetcher(object):
     """A Fetcher obtains data with which to populate a DataAssembly.  """
 
-    def __init__(self, location, local_filename):
+    def __init__(self, location, local_filename, sha1=None):
         self.location = location
         self.local_filename = local_filename
+        self.sha1 = sha1  # expected SHA-1 hash, if known
         self.local_dir_path = os.path.join(_local_data_path, self.local_filename)
         os.makedirs(self.local_dir_path, exist_ok=True)
+        # SHA-1 hash computed while downloading, if this fetcher downloaded the resource
+        self.downloaded_sha1 = None
 
     def fetch(self):
         """
@@ -39,63 +76,122 @@ class Fetcher(object):
         raise NotImplementedError("The base Fetcher class does not implement .fetch().  Use a subclass of Fetcher.")
 
 
+S3_COMPATIBLE_SCHEME_PREFIX = 's3+'
+
+
+def parse_s3_location(location):
+    """
+    :return: the bucket name and object key of an S3 url in virtual-hosted or path style.
+        Urls of S3-compatible object stores (`s3+https://host:port/bucket/key`) are always in path style.
+    """
+    parsed_url = urlparse(location)
+    split_path = parsed_url.path.lstrip('/').split("/")
+    # http://docs.aws.amazon.com/AmazonS3/latest/dev/UsingBucket.html#access-bucket-intro
+    virtual_hosted_style = 's3.' in parsed_url.hostname  # s3. for virtual hosted style; s3- for older AWS
+    virtual_hosted_style = virtual_hosted_style and not parsed_url.scheme.startswith(S3_COMPATIBLE_SCHEME_PREFIX)
+    if virtual_hosted_style:
+        return parsed_url.hostname.split(".s3.")[0], os.path.join(*split_path)
+    return split_path[0], os.path.join(*split_path[1:])
+
+
+def s3_endpoint_url(location):
+    """
+    :return: the endpoint url of an S3-compatible object store for `s3+http(s)://` urls, None for AWS S3 urls
+    """
+    parsed_url = urlparse(location)
+    if not parsed_url.scheme.startswith(S3_COMPATIBLE_SCHEME_PREFIX):
+        return None
+    return f"{parsed_url.scheme[len(S3_COMPATIBLE_SCHEME_PREFIX):]}://{parsed_url.netloc}"
+
+
 class BotoFetcher(Fetcher):
     """A Fetcher that retrieves files from Amazon Web Services' S3 data storage.  """
 
-    def __init__(self, location, local_filename):
-        super(BotoFetcher, self).__init__(location, local_filename)
-        parsed_url = urlparse(self.location)
-        split_path = parsed_url.path.lstrip('/').split("/")
-        # http://docs.aws.amazon.com/AmazonS3/latest/dev/UsingBucket.html#access-bucket-intro
-        virtual_hosted_style = 's3.' in parsed_url.hostname  # s3. for virtual hosted style; s3- for older AWS
-        if virtual_hosted_style:
-            self.bucketname = parsed_url.hostname.split(".s3.")[0]
-            self.relative_path = os.path.join(*(split_path))
-        else:
-            self.bucketname = split_path[0]
-            self.relative_path = os.path.join(*(split_path[1:]))
+    def __init__(self, location, local_filename, sha1=None):
+        super(BotoFetcher, self).__init__(location, local_filename, sha1=sha1)
+        self.bucketname, self.relative_path = parse_s3_location(self.location)
+        self.endpoint_url = s3_endpoint_url(self.location)
         self.output_filename = os.path.join(self.local_dir_path, self.relative_path)
         self._logger = logging.getLogger(fullname(self))
 
     def fetch(self):
         if not os.path.exists(self.output_filename):
-            self.download_boto()
+            with artifact_lock(self.output_filename):
+                if not os.path.exists(self.output_filename):  # another process might have downloaded it meanwhile
+                    self.download_boto()
         return self.output_filename
 
     def download_boto(self):
-        """Downloads file from S3 via boto at `url` and writes it in `self.output_filename`."""
+        """
+        Downloads file from S3 via boto at `url` and writes it in `self.output_filename`.
+        Interrupted downloads are resumed, and the file only appears at `self.output_filename` once its hash matches.
+        """
         self._logger.info('downloading %s' % self.relative_path)
-        try:  # try with authentication
-            self._logger.debug("attempting default download (signed)")
-            self.download_boto_config(config=None)
-        except Exception as e_signed:  # try without authentication
-            self._logger.debug("default download failed, trying unsigned")
-            # disable signing requests. see https://stackoverflow.com/a/34866092/2225200
-            unsigned_config = Config(signature_version=UNSIGNED)
-            try:
-                self.download_boto_config(config=unsigned_config)
-            except Exception as e_unsigned:
-                # when unsigned download also fails, raise both exceptions
-                # raise Exception instead of specific type to avoid missing __init__ arguments
-                raise Exception([e_signed, e_unsigned])
-
-    def download_boto_config(self, config):
-        s3 = boto3.resource('s3', config=config)
-        obj = s3.Object(self.bucketname, self.relative_path)
-        # show progress. see https://gist.github.com/wy193777/e7607d12fad13459e8992d4f69b53586
-        with tqdm(total=obj.content_length, unit='B', unit_scale=True,
-                  desc=self.bucketname + "/" + self.relative_path) as progress_bar:
-            def progress_hook(bytes_amount):
-                if bytes_amount > 0:  # at the end, this sometimes passes a negative byte amount which tqdm can't handle
-                    progress_bar.update(bytes_amount)
-
-            obj.download_file(self.output_filename, Callback=progress_hook)
-
-
-def verify_sha1(filepath, sha1):
-    actual_hash = sha1_hash(filepath)
+        self.downloaded_sha1 = download_s3_object(self.bucketname, self.relative_path, self.output_filename,
+                                                  sha1=self.sha1, endpoint_url=self.endpoint_url)
+
+
+class LocalFetcher(Fetcher):
+    """
+    A Fetcher for files that are already on a (shared) file system, given as a `file://` url or a plain path.
+    Files are linked into the local data path instead of being copied.
+    """
+
+    def __init__(self, location, local_filename, sha1=None):
+        super(LocalFetcher, self).__init__(location, local_filename, sha1=sha1)
+        parsed_url = urlparse(self.location)
+        self.source_path = url2pathname(parsed_url.path) if parsed_url.scheme == 'file' else self.location
+        self.output_filename = os.path.join(self.local_dir_path, os.path.basename(self.source_path))
+        self._logger = logging.getLogger(fullname(self))
+
+    def fetch(self):
+        if not os.path.lexists(self.output_filename):
+            with artifact_lock(self.output_filename):
+                if not os.path.lexists(self.output_filename):
+                    if not os.path.isfile(self.source_path):
+                        raise FileNotFoundError(f"No file at {self.source_path}")
+                    self._logger.info(f"linking {self.source_path}")
+                    try:
+                        os.symlink(os.path.abspath(self.source_path), self.output_filename)
+                    except OSError:  # e.g. no symlink permission on Windows
+                        shutil.copyfile(self.source_path, self.output_filename)
+        return self.output_filename
+
+
+class HTTPFetcher(Fetcher):
+    """A Fetcher that downloads files over plain HTTP(S), re-using connections across downloads.  """
+
+    def __init__(self, location, local_filename, sha1=None):
+        super(HTTPFetcher, self).__init__(location, local_filename, sha1=sha1)
+        self.output_filename = os.path.join(self.local_dir_path, os.path.basename(urlparse(self.location).path))
+        self._logger = logging.getLogger(fullname(self))
+
+    def fetch(self):
+        if not os.path.exists(self.output_filename):
+            with artifact_lock(self.output_filename):
+                if not os.path.exists(self.output_filename):
+                    self._logger.info(f"downloading {self.location}")
+                    self.downloaded_sha1 = download_http(self.location, self.output_filename, sha1=self.sha1)
+        return self.output_filename
+
+
+def verify_sha1(filepath, sha1, strict=None, actual_hash=None):
+    """
+    Verifies that the file at `filepath` has the given SHA-1 hash.
+    Files that were verified before and have not changed since are not re-hashed unless `strict` is set.
+    :param strict: whether to always re-hash the file.
+        Defaults to the `BRAINIO_STRICT_VERIFICATION` environment variable.
+    :param actual_hash: the file's hash if it is already known, e.g. because it was computed while downloading
+    """
+    strict = _strict_verification if strict is None else strict
+    if actual_hash is None and not strict and verification_index.verified_sha1(filepath) == sha1:
+        _logger.debug(f"sha1 OK (unchanged since verification): {filepath}")
+        return
+    actual_hash = actual_hash or sha1_hash(filepath)
     if sha1 != actual_hash:
+        verification_index.forget(filepath)
         raise IOError(f"File '{filepath}': invalid SHA-1 hash {actual_hash} (expected {sha1})")
+    verification_index.record(filepath, sha1)
     _logger.debug(f"sha1 OK: {filepath}")
 
 
@@ -104,16 +200,30 @@ class AssemblyLoader:
     Loads an assembly from a file.
     """
 
-    def __init__(self, local_path, stimulus_set_identifier, cls):
+    def __init__(self, local_path, stimulus_set_identifier, cls, chunks=None, backend='netcdf', sha1=None,
+                 lazy_stimulus_set_meta=False):
         self.local_path = local_path
         self.stimulus_set_identifier = stimulus_set_identifier
         self.assembly_class = cls
+        self.chunks = chunks
+        self.backend = backend
+        self.sha1 = sha1
+        self.lazy_stimulus_set_meta = lazy_stimulus_set_meta
 
     def load(self):
-        data_array = xr.open_dataarray(self.local_path)
+        if self.backend == 'memmap':
+            data_array = self.open_memmap()
+        elif self.backend == 'netcdf':
+            data_array = xr.open_dataarray(self.local_path, chunks=self.chunks)
+        else:
+            raise ValueError(f"Unknown assembly backend {self.backend}")
+        if self.chunks is not None:
+            # only the values stay lazy: coordinates are small and needed right away to merge metadata and build indexes
+            for coord in data_array.coords.values():
+                coord.variable.load()
         stimulus_set = get_stimulus_set(self.stimulus_set_identifier)
         class_object = getattr(assemblies_base, self.assembly_class)
-        if self.assembly_class == 'PropertyAssembly':
+        if self.assembly_class == 'PropertyAssembly' or self.lazy_stimulus_set_meta:
             result = data_array
         else:
             result = self.merge_stimulus_set_meta(data_array, stimulus_set)
@@ -122,49 +232,337 @@ class AssemblyLoader:
         result.attrs["stimulus_set"] = stimulus_set
         return result
 
+    def open_memmap(self):
+        """
+        Opens the memory-mapped copy of the assembly file, building it from the verified NetCDF file if necessary.
+        Falls back to the NetCDF file for values that cannot be memory-mapped.
+        """
+        store_directory = memmap_store_path(self.local_path)
+        data_array = open_memmap_store(store_directory, sha1=self.sha1)
+        if data_array is not None:
+            return data_array
+        with artifact_lock(store_directory):
+            data_array = open_memmap_store(store_directory, sha1=self.sha1)  # another process might have built it
+            if data_array is not None:
+                return data_array
+            _logger.debug(f"Building memory-mapped store {store_directory}")
+            with xr.open_dataarray(self.local_path) as netcdf_data_array:
+                try:
+                    write_memmap_store(netcdf_data_array, store_directory, sha1=self.sha1)
+                except ValueError as e:
+                    _logger.warning(f"Cannot memory-map {self.local_path}, using NetCDF instead: {e}")
+                    return xr.open_dataarray(self.local_path)
+            _record_size(store_directory, 'memmap_store', directory_size(store_directory))
+        return open_memmap_store(store_directory, sha1=self.sha1)
+
     def merge_stimulus_set_meta(self, assy, stimulus_set):
+        """
+        Attaches every stimulus set column that is not yet a presentation coordinate to the assembly,
+        aligned by `image_id`. Presentations whose image is not in the stimulus set receive missing values.
+        """
         axis_name, index_column = "presentation", "image_id"
-        df_of_coords = pd.DataFrame(coords_for_dim(assy, axis_name))
-        cols_to_use = stimulus_set.columns.difference(df_of_coords.columns.difference([index_column]))
-        merged = df_of_coords.merge(stimulus_set[cols_to_use], on=index_column, how="left")
-        for col in stimulus_set.columns:
-            assy[col] = (axis_name, merged[col])
-        return assy
+        # position of every presentation's image in the stimulus set, -1 for images not in the stimulus set
+        indexer = stimulus_set_index(stimulus_set).get_indexer(assy[index_column].values)
+        presentation_coords = [name for name, coord in assy.coords.items() if coord.dims == (axis_name,)]
+        new_columns = [column for column in stimulus_set.columns if column not in presentation_coords]
+        return assy.assign_coords({
+            # categorical columns (from the metadata sidecar) become regular coordinate values
+            column: (axis_name, np.asarray(pd.api.extensions.take(stimulus_set[column].values, indexer,
+                                                                  allow_fill=True)))
+            for column in new_columns})
 
 
 class StimulusSetLoader:
-    def __init__(self, csv_path, stimuli_directory, cls):
+    def __init__(self, csv_path, stimuli_directory, cls, extraction_manifest=None, csv_sha1=None):
+        """
+        :param extraction_manifest: the manifest of the extracted stimuli (see `read_extraction_manifest`).
+            If given, images are checked against the manifest's members instead of one file system call per image.
+        :param csv_sha1: the verified hash of the csv file. If given, metadata is read from the csv file's
+            typed sidecar when possible (see `metadata_sidecar.read_metadata`).
+        """
         self.csv_path = csv_path
         self.stimuli_directory = stimuli_directory
         self.cls = cls
+        self.extraction_manifest = extraction_manifest
+        self.csv_sha1 = csv_sha1
+
+    def load(self):
+        stimulus_set = read_metadata(self.csv_path, csv_sha1=self.csv_sha1)
+        stimulus_set = StimulusSet(stimulus_set)
+        stimulus_set.image_paths = ImagePaths(stimulus_set['image_id'].values, stimulus_set['filename'].values,
+                                              prefix=os.path.join(self.stimuli_directory, ''))
+        if self.extraction_manifest is not None:
+            members = self.extraction_manifest['members']
+            assert all(filename in members for filename in stimulus_set['filename'].values)
+        else:
+            assert all(os.path.isfile(image_path) for image_path in stimulus_set.image_paths.paths())
+        return stimulus_set
+
+
+class ZipImageGetter:
+    """
+    `get_image` of stimulus sets that are served from their zip file: returns a binary file-like object of the image.
+    """
+
+    def __init__(self, zip_store, image_paths):
+        self.zip_store = zip_store
+        self.image_paths = image_paths
+
+    def __call__(self, image_id):
+        return self.zip_store.open(self.image_paths[image_id])
+
+
+class ZipStimulusSetLoader:
+    """
+    Loads a StimulusSet whose images are read directly from the (memory-mapped) zip file instead of being extracted.
+    `image_paths` maps each `image_id` to the image's name within the zip file.
+    """
+
+    def __init__(self, csv_path, zip_path, cls, csv_sha1=None):
+        self.csv_path = csv_path
+        self.zip_path = zip_path
+        self.cls = cls
+        self.csv_sha1 = csv_sha1
 
     def load(self):
-        stimulus_set = pd.read_csv(self.csv_path)
+        stimulus_set = read_metadata(self.csv_path, csv_sha1=self.csv_sha1)
         stimulus_set = StimulusSet(stimulus_set)
-        stimulus_set.image_paths = {row['image_id']: os.path.join(self.stimuli_directory, row['filename'])
-                                    for _, row in stimulus_set.iterrows()}
-        assert all(os.path.isfile(image_path) for image_path in stimulus_set.image_paths.values())
+        zip_store = ZipImageStore(self.zip_path)
+        stimulus_set.image_paths = ImagePaths(stimulus_set['image_id'].values, stimulus_set['filename'].values)
+        assert all(name in zip_store for name in stimulus_set.image_paths.filenames), \
+            "Inconsistency: csv paths missing from the zip file"
+        stimulus_set.get_image = ZipImageGetter(zip_store, stimulus_set.image_paths)
         return stimulus_set
 
 
 _fetcher_types = {
     "S3": BotoFetcher,
+    "file": LocalFetcher,
+    "http": HTTPFetcher,
 }
 
 
-def get_fetcher(type="S3", location=None, local_filename=None):
-    return _fetcher_types[type](location, local_filename)
+def register_fetcher(location_type, fetcher_class):
+    """
+    Registers a `Fetcher` subclass for lookup rows (or redirects) with the given `location_type`.
+    Registering an existing location type replaces its fetcher.
+    """
+    _fetcher_types[location_type] = fetcher_class
+
+
+def get_fetcher(type="S3", location=None, local_filename=None, sha1=None):
+    if type not in _fetcher_types:
+        raise ValueError(f"No fetcher registered for location type {type}, "
+                         f"registered are {list(_fetcher_types)}. See `register_fetcher`.")
+    return _fetcher_types[type](location, local_filename, sha1=sha1)
+
+
+def _parse_bucket_redirects(value):
+    redirects = {}
+    for redirect in filter(None, value.split(';')):
+        bucket, _, base_url = redirect.partition('=')
+        redirects[bucket.strip()] = base_url.strip().rstrip('/')
+    return redirects
+
+
+# bucket -> base url, e.g. `brainio.dicarlo=file:///mirror/brainio.dicarlo;brainio-contrib=https://cache/contrib`
+bucket_redirects = _parse_bucket_redirects(os.getenv('BRAINIO_BUCKET_REDIRECTS', ''))
+
 
+# ordered base urls that are tried before the lookup location, each holding `<base url>/<bucket>/<key>`.
+# e.g. `file:///datasets/brainio;s3+http://object-store.local:9000;https://cache.local/brainio`
+mirrors = [mirror.strip().rstrip('/') for mirror in os.getenv('BRAINIO_MIRRORS', '').split(';') if mirror.strip()]
 
-def fetch_file(location_type, location, sha1):
-    filename = filename_from_link(location)
-    fetcher = get_fetcher(type=location_type, location=location,
-                          local_filename=filename)
+
+def location_type_from_url(url):
+    scheme = urlparse(url).scheme
+    if scheme in ('', 'file'):
+        return 'file'
+    if scheme in ('http', 'https'):
+        return 'http'
+    if scheme.startswith(S3_COMPATIBLE_SCHEME_PREFIX):
+        return 'S3'
+    raise ValueError(f"Cannot tell the location type of {url}")
+
+
+def candidate_locations(location_type, location):
+    """
+    Where to fetch an S3 location from, in order: its bucket's redirect (see `bucket_redirects`), the `mirrors`,
+    and finally the location itself. Other locations are only fetched from the location itself.
+    :return: a list of (location type, location) tuples
+    """
+    if location_type != 'S3' or not (bucket_redirects or mirrors):
+        return [(location_type, location)]
+    bucket, key = parse_s3_location(location)
+    base_urls = [f"{mirror}/{bucket}" for mirror in mirrors]
+    if bucket in bucket_redirects:
+        base_urls.insert(0, bucket_redirects[bucket])
+    candidates = [(location_type_from_url(base_url), f"{base_url}/{key}") for base_url in base_urls]
+    return candidates + [(location_type, location)]
+
+
+def fetch_file(location_type, location, sha1, strict=None):
+    """
+    Fetches the file from the first of its `candidate_locations` that can provide it with the expected hash.
+    """
+    local_path, _ = _fetch_file(location_type, location, sha1, strict=strict)
+    return local_path
+
+
+def _fetch_file(location_type, location, sha1, strict=None):
+    """
+    :return: the local path, and whether the file was already present locally (a cache hit)
+    """
+    filename = local_directory_name(location, sha1)  # does not depend on where the file is fetched from
+    cache = DiskCache(_local_data_path)
+    with cache.pinned(filename):  # protect the artifact from eviction while fetching it
+        candidates = candidate_locations(location_type, location)
+        for candidate_number, (candidate_type, candidate_location) in enumerate(candidates):
+            try:
+                fetcher = get_fetcher(type=candidate_type, location=candidate_location,
+                                      local_filename=filename, sha1=sha1)
+                output_filename = getattr(fetcher, 'output_filename', None)
+                hit = output_filename is not None and os.path.isfile(output_filename)
+                if sha1 and output_filename is not None:
+                    hit = _link_from_blob(sha1, output_filename) or hit
+                    if not hit:
+                        hit = _adopt_legacy_file(sha1, output_filename, location)
+                local_path = _fetch_verified(fetcher, sha1, strict=strict)
+                if sha1:
+                    _store_blob(local_path, sha1)
+                break
+            except Exception as e:
+                if candidate_number == len(candidates) - 1:
+                    raise
+                _logger.warning(f"Could not fetch {candidate_location}, trying the next location: {e}")
+        cache.record_access(filename, hit=hit)
+        if not hit:
+            # symlinked files, e.g. on a shared file system, do not take up space in `BRAINIO_HOME`
+            cache.record_size(filename, os.path.basename(local_path),
+                              0 if os.path.islink(local_path) else os.path.getsize(local_path))
+            enforce_quota(cache)
+    return local_path, hit
+
+
+def _record_size(path, component, size):
+    """
+    Records the size of a file or directory derived from a fetched file, for the artifact that contains `path`.
+    """
+    relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(_local_data_path))
+    if relative_path.startswith(os.pardir):  # not in `BRAINIO_HOME`
+        return
+    DiskCache(_local_data_path).record_size(relative_path.split(os.sep)[0], component, size)
+
+
+def _pin_for_process(*lookups):
+    """
+    Pins the artifacts of the lookup rows until the process exits:
+    values and images are read from them lazily long after they were loaded.
+    """
+    cache = DiskCache(_local_data_path)
+    for lookup in lookups:
+        cache.pin(local_directory_name(lookup['location'], lookup['sha1']))
+
+
+def _fetch_verified(fetcher, sha1, strict=None):
     local_path = fetcher.fetch()
-    verify_sha1(local_path, sha1)
+    try:
+        verify_sha1(local_path, sha1, strict=strict, actual_hash=fetcher.downloaded_sha1)
+    except IOError:
+        os.remove(local_path)
+        if fetcher.downloaded_sha1 is not None:
+            raise
+        # a pre-existing local file is corrupt, e.g. left over from an interrupted download. Fetch it again.
+        _logger.warning(f"Removed corrupt file {local_path}, fetching it again")
+        local_path = fetcher.fetch()
+        try:
+            verify_sha1(local_path, sha1, strict=strict, actual_hash=fetcher.downloaded_sha1)
+        except IOError:
+            os.remove(local_path)
+            raise
     return local_path
 
 
+def blob_path(sha1):
+    """
+    :return: the path of the content-addressed copy of the file with the given SHA-1 hash.
+        The human-readable paths of all files with this hash are hard links (or symlinks) to it.
+    """
+    return os.path.join(_local_data_path, BLOBS_DIRECTORY, sha1[:2], sha1)
+
+
+def _link_from_blob(sha1, output_filename):
+    """
+    Points `output_filename` to the stored blob with the given hash, e.g. for a file that was already downloaded
+    from another bucket or under another key, or for a corrupt local file.
+    Only blobs that were verified and have not changed since are used.
+    :return: whether a blob was linked
+    """
+    path = blob_path(sha1)
+    if verification_index.verified_sha1(path) != sha1:
+        return False
+    if os.path.exists(output_filename) and os.path.samefile(path, output_filename):
+        return True
+    _logger.debug(f"Linking {output_filename} to blob {path}")
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    _link(path, output_filename)
+    verification_index.record(output_filename, sha1)
+    return True
+
+
+def _adopt_legacy_file(sha1, output_filename, location):
+    """
+    Links a file with the expected hash from its legacy directory, which was named without the hash prefix
+    (see `local_directory_name`), to `output_filename` so that caches from before are not downloaded again.
+    :return: whether a file was adopted
+    """
+    local_directory = os.path.join(_local_data_path, local_directory_name(location, sha1))
+    relative_path = os.path.relpath(output_filename, local_directory)
+    legacy_path = os.path.join(_local_data_path, filename_from_link(location), relative_path)
+    if not os.path.isfile(legacy_path):
+        return False
+    try:
+        verify_sha1(legacy_path, sha1)
+    except IOError:  # a different file with the same basename
+        return False
+    _logger.info(f"Adopting {legacy_path} as {output_filename}")
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    _link(legacy_path, output_filename)
+    verification_index.record(output_filename, sha1)
+    return True
+
+
+def _store_blob(local_path, sha1):
+    """
+    Makes the blob with the given hash point to the verified file at `local_path`.
+    """
+    if os.path.islink(local_path):  # e.g. a file on a shared file system, or already linked to the blob
+        return
+    path = blob_path(sha1)
+    if os.path.exists(path) and os.path.samefile(path, local_path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _link(local_path, path)
+    verification_index.record(path, sha1)
+
+
+def _link(source, link_path):
+    """
+    Atomically replaces `link_path` with a hard link to `source`,
+    or a symlink if the file system does not support hard links.
+    """
+    temp_path = f"{link_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        os.symlink(os.path.abspath(source), temp_path)
+    try:
+        os.replace(temp_path, link_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
 def filename_from_link(location):
     parse = urlparse(location)
     local_name = os.path.basename(parse.path)
@@ -172,41 +570,209 @@ def filename_from_link(location):
     return local_name
 
 
-def unzip(zip_path):
+def local_directory_name(location, sha1):
+    """
+    :return: the name of the directory in `BRAINIO_HOME` that the file and everything derived from it are stored in.
+        It includes a prefix of the file's hash, so that different files with the same basename never share a
+        directory, e.g. the extracted images of two zip files.
+    """
+    name = filename_from_link(location)
+    return f"{name}_{sha1[:SHA1_PREFIX_LENGTH]}" if sha1 else name
+
+
+def extraction_manifest_path(zip_path):
+    return zip_path + EXTRACTION_MANIFEST_SUFFIX
+
+
+def read_extraction_manifest(zip_path):
+    """
+    :return: the manifest of a completed extraction of the zip file, with the zip file's identity (`zip`)
+        and the extracted `members` with their sizes, or None if the zip file was not (completely) extracted
+        or has changed since
+    """
+    manifest = read_json(extraction_manifest_path(zip_path))
+    if manifest is None or manifest.get('zip') != file_identity(zip_path):
+        return None
+    return manifest
+
+
+def unzip(zip_path, max_workers=None, deep_verify=False):
+    """
+    Extracts the zip file into its directory, member by member and in parallel.
+    Members that already exist with the right size are not extracted again.
+    Once all members are extracted, a manifest next to the zip file records the zip file's identity and the
+    extracted members with their sizes, so that later calls return immediately without listing the zip file's members.
+    :param max_workers: number of members extracted in parallel.
+        Defaults to the `BRAINIO_EXTRACT_CONCURRENCY` environment variable or 8.
+    :param deep_verify: if True, ignore the manifest and check the size of every extracted member
+    """
     containing_dir = os.path.dirname(zip_path)
-    with zipfile.ZipFile(zip_path, 'r') as zip_file:
-        if not all(map(lambda filename: os.path.exists(os.path.join(containing_dir, filename)), zip_file.namelist())):
-            _logger.debug(f"Extractall to {containing_dir}")
-            zip_file.extractall(containing_dir)
+    if not deep_verify and read_extraction_manifest(zip_path) is not None:
+        return containing_dir
+    # hold the lock while checking too: files of an extraction in progress exist before they are fully written
+    with artifact_lock(zip_path):
+        if not deep_verify and read_extraction_manifest(zip_path) is not None:
+            return containing_dir
+        with zipfile.ZipFile(zip_path, 'r') as zip_file:
+            members = zip_file.infolist()
+        missing_members = [member for member in members if not _is_member_extracted(member, containing_dir)]
+        if missing_members:
+            _logger.debug(f"Extracting {len(missing_members)}/{len(members)} members to {containing_dir}")
+            thread_local = threading.local()
+            thread_local_zip_files = []
+
+            def extract(member):
+                # ZipFile objects are not safe to share between threads
+                if not hasattr(thread_local, 'zip_file'):
+                    thread_local.zip_file = zipfile.ZipFile(zip_path, 'r')
+                    thread_local_zip_files.append(thread_local.zip_file)
+                _extract_member(thread_local.zip_file, member, containing_dir)
+
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers or _default_extract_concurrency) as executor:
+                    list(executor.map(extract, missing_members))
+            finally:
+                for zip_file in thread_local_zip_files:
+                    zip_file.close()
+        manifest = {'zip': file_identity(zip_path),
+                    'members': {member.filename: member.file_size for member in members if not member.is_dir()}}
+        write_json_atomic(extraction_manifest_path(zip_path), manifest)
+        _record_size(zip_path, 'extracted', sum(manifest['members'].values()))
     return containing_dir
 
 
-def get_assembly(identifier):
+def _member_path(member, directory):
+    path = os.path.abspath(os.path.join(directory, member.filename))
+    if os.path.commonpath([path, os.path.abspath(directory)]) != os.path.abspath(directory):
+        raise ValueError(f"Zip member {member.filename} would be extracted outside of {directory}")
+    return path
+
+
+def _is_member_extracted(member, directory):
+    path = _member_path(member, directory)
+    if member.is_dir():
+        return os.path.isdir(path)
+    try:
+        return os.path.getsize(path) == member.file_size
+    except OSError:
+        return False
+
+
+def _extract_member(zip_file, member, directory):
+    path = _member_path(member, directory)
+    if member.is_dir():
+        os.makedirs(path, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write under a temporary name so that an interrupted extraction never leaves a truncated file in place
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with zip_file.open(member) as source, open(temp_path, 'wb') as target:
+            shutil.copyfileobj(source, target, length=1024 * 1024)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def get_assembly(identifier, use_cache=None, chunks=None, backend=None, lazy_stimulus_set_meta=False):
+    """
+    Retrieves the assembly with the given identifier.
+    :param use_cache: whether to serve the assembly from (and store it in) the in-process `assembly_cache`.
+        Defaults to the `BRAINIO_ASSEMBLY_CACHE` environment variable or False.
+        Cached assemblies are loaded into memory, and their values are shared with other callers and read-only.
+    :param chunks: if set, the assembly values are loaded lazily as a dask array with these chunk sizes
+        (see `xarray.open_dataarray`), e.g. `{'time_bin': 1}`. Values are only read for the parts of the assembly
+        that are computed. Lazily-loaded assemblies are never cached.
+    :param backend: 'netcdf' to read values from the downloaded NetCDF file, or 'memmap' to read them from a
+        memory-mapped raw copy that is built on first use and shared between processes through the page cache.
+        Defaults to the `BRAINIO_ASSEMBLY_BACKEND` environment variable or 'netcdf'.
+    :param lazy_stimulus_set_meta: if True, stimulus set columns are not copied onto the presentation dimension.
+        Instead, they are resolved on first access through `assembly.stimulus_set_meta[column]`
+        (see `StimulusSetMetaAccessor`).
+    """
+    backend = backend or ('netcdf' if chunks is not None else _default_assembly_backend)
+    if chunks is not None and backend != 'netcdf':
+        raise ValueError(f"chunks can only be used with the netcdf backend, not {backend}")
+    use_cache = (_default_use_cache if use_cache is None else use_cache) and chunks is None
     assembly_lookup = lookup_assembly(identifier)
+    cache_key = (identifier, assembly_lookup['sha1'], lazy_stimulus_set_meta)
+    if use_cache:
+        assembly = assembly_cache.get(cache_key)
+        if assembly is not None:
+            return assembly
+    _pin_for_process(assembly_lookup)
     local_path = fetch_file(location_type=assembly_lookup['location_type'],
                             location=assembly_lookup['location'], sha1=assembly_lookup['sha1'])
     loader = AssemblyLoader(local_path, cls=assembly_lookup['class'],
-                            stimulus_set_identifier=assembly_lookup['stimulus_set_identifier'])
+                            stimulus_set_identifier=assembly_lookup['stimulus_set_identifier'],
+                            chunks=chunks, backend=backend, sha1=assembly_lookup['sha1'],
+                            lazy_stimulus_set_meta=lazy_stimulus_set_meta)
     assembly = loader.load()
     assembly.attrs['identifier'] = identifier
+    if use_cache:
+        assembly = assembly_cache.put(cache_key, assembly)
     return assembly
 
 
-def get_stimulus_set(identifier):
+def fetch_metadata_sidecar(csv_lookup, csv_path):
+    """
+    Fetches the typed metadata sidecar that packaging uploads next to the csv file, so that `read_metadata` reads it
+    instead of parsing the csv file. The sidecar is not part of the lookup: instead of a hash, `read_metadata` checks
+    that it was derived from the verified csv file. Stimulus sets packaged without a sidecar fall back to the csv file.
+    """
+    if feather is None or os.path.isfile(sidecar_path(csv_path)):
+        return
+    location = os.path.splitext(csv_lookup['location'])[0] + SIDECAR_SUFFIX
+    try:
+        fetcher = get_fetcher(type=csv_lookup['location_type'], location=location,
+                              local_filename=local_directory_name(csv_lookup['location'], csv_lookup['sha1']))
+        local_path = fetcher.fetch()
+    except Exception as e:  # e.g. packaged before sidecars were uploaded
+        _logger.debug(f"No metadata sidecar at {location}: {e}")
+        return
+    _record_size(local_path, os.path.basename(local_path), os.path.getsize(local_path))
+
+
+def get_stimulus_set(identifier, extract=True, deep_verify=False):
+    """
+    Retrieves the stimulus set with the given identifier.
+    :param extract: if False, images are not extracted into `BRAINIO_HOME` but read from the zip file on demand:
+        `get_image` then returns a binary file-like object instead of a path, and `image_paths` holds the images'
+        names within the zip file (see `ZipStimulusSetLoader`).
+    :param deep_verify: if True, check the extracted images on disk: the size of every image, and that the stimuli
+        directory contains exactly the stimulus set's images. By default, images are checked against the manifest
+        recorded when they were extracted, without accessing the individual files.
+    """
     csv_lookup, zip_lookup = lookup_stimulus_set(identifier)
+    _pin_for_process(csv_lookup, zip_lookup)
     csv_path = fetch_file(location_type=csv_lookup['location_type'], location=csv_lookup['location'],
                           sha1=csv_lookup['sha1'])
+    fetch_metadata_sidecar(csv_lookup, csv_path)
     zip_path = fetch_file(location_type=zip_lookup['location_type'], location=zip_lookup['location'],
                           sha1=zip_lookup['sha1'])
-    stimuli_directory = unzip(zip_path)
-    loader = StimulusSetLoader(csv_path=csv_path, stimuli_directory=stimuli_directory, cls=csv_lookup['class'])
+    if not extract:
+        loader = ZipStimulusSetLoader(csv_path=csv_path, zip_path=zip_path, cls=csv_lookup['class'],
+                                      csv_sha1=csv_lookup['sha1'])
+        stimulus_set = loader.load()
+        stimulus_set.identifier = identifier
+        return stimulus_set
+    stimuli_directory = unzip(zip_path, deep_verify=deep_verify)
+    extraction_manifest = None if deep_verify else read_extraction_manifest(zip_path)
+    loader = StimulusSetLoader(csv_path=csv_path, stimuli_directory=stimuli_directory, cls=csv_lookup['class'],
+                               extraction_manifest=extraction_manifest, csv_sha1=csv_lookup['sha1'])
     stimulus_set = loader.load()
     stimulus_set.identifier = identifier
     # ensure perfect overlap
-    stimuli_paths = [os.path.join(stimuli_directory, local_path) for local_path in os.listdir(stimuli_directory)
-                     if not local_path.endswith('.zip') and not local_path.endswith('.csv')]
-    assert set(stimulus_set.image_paths.values()) == set(stimuli_paths), \
-        "Inconsistency: unzipped stimuli paths do not match csv paths"
+    if extraction_manifest is not None:
+        assert set(stimulus_set['filename'].values) == set(extraction_manifest['members']), \
+            "Inconsistency: extracted stimuli paths do not match csv paths"
+    else:
+        stimuli_paths = [os.path.join(stimuli_directory, local_path) for local_path in os.listdir(stimuli_directory)
+                         if not local_path.endswith(('.zip', '.csv', EXTRACTION_MANIFEST_SUFFIX, SIDECAR_SUFFIX))]
+        assert set(stimulus_set.image_paths.paths()) == set(stimuli_paths), \
+            "Inconsistency: unzipped stimuli paths do not match csv paths"
     return stimulus_set
 
 
@@ -0,0 +1,31 @@
+import json
+import os
+import tempfile
+
+
+def write_json_atomic(path, content):
+    """
+    Writes `content` as json to `path` via a temporary file in the same directory,
+    so that readers never see a partially written file.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as f:
+            json.dump(content, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_json(path, default=None):
+    """
+    :return: the json content of the file at `path`, or `default` if the file does not exist or is corrupt
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
@@ -0,0 +1,57 @@
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+
+class ImagePaths(Mapping):
+    """
+    Read-only mapping from `image_id` to image path, stored as one directory prefix and an array of filenames
+    relative to it. Full paths are only built when looked up, and an `image_id` index finds the position of an image.
+    Like a dict built from the rows in order, the last row wins for duplicate `image_id`s.
+    """
+
+    def __init__(self, image_ids, filenames, prefix=''):
+        """
+        :param image_ids: array-like of image ids, one per filename
+        :param filenames: array-like of filenames relative to `prefix`
+        :param prefix: prepended to every filename, e.g. the stimuli directory with a trailing separator
+        """
+        index = pd.Index(image_ids)
+        filenames = np.asarray(filenames)
+        if len(index) != len(filenames):
+            raise ValueError(f"Got {len(index)} image ids but {len(filenames)} filenames")
+        if not index.is_unique:
+            keep = ~index.duplicated(keep='last')
+            index, filenames = index[keep], filenames[keep]
+        self.index = index
+        self.filenames = filenames
+        self.prefix = prefix
+
+    def __getitem__(self, image_id):
+        try:
+            position = self.index.get_loc(image_id)
+        except (KeyError, TypeError):
+            raise KeyError(image_id)
+        return self.prefix + self.filenames[position]
+
+    def __contains__(self, image_id):
+        try:
+            return image_id in self.index
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def paths(self):
+        """
+        :return: all paths as an array, in the order of the image ids
+        """
+        return np.array([self.prefix + filename for filename in self.filenames], dtype=object)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(prefix={self.prefix!r}, {len(self)} images)"
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+_default_lease_seconds = float(os.getenv('BRAINIO_LOCK_LEASE_SECONDS', 120))
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+class FileLock:
+    """
+    A cross-process lock based on exclusively creating a lock file, which also works on shared network filesystems.
+    While the lock is held, a background thread renews the lease by touching the lock file.
+    A lock file whose modification time has not changed for `lease_seconds` belongs to a crashed holder and is broken.
+    Staleness is judged with the waiter's own clock so that clock skew between hosts does not matter.
+    """
+
+    def __init__(self, lock_path, lease_seconds=None, poll_seconds=0.5, timeout=None):
+        self.lock_path = lock_path
+        self.lease_seconds = lease_seconds or _default_lease_seconds
+        self.poll_seconds = poll_seconds
+        self.timeout = timeout
+        self._token = None
+        self._stop_renewal = None
+        self._renewal_thread = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        start = time.monotonic()
+        observed = None  # (owner, mtime) of the current lock file, and when it was first observed
+        while True:
+            token = {'token': uuid.uuid4().hex, 'host': socket.gethostname(), 'pid': os.getpid()}
+            try:
+                file_descriptor = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(file_descriptor, 'w') as f:
+                    json.dump(token, f)
+                self._token = token['token']
+                self._start_renewal()
+                return self
+            state = self._read_state()
+            now = time.monotonic()
+            if state is not None:
+                if observed is None or observed[0] != state:
+                    observed = (state, now)
+                elif now - observed[1] > self.lease_seconds:
+                    _logger.warning(f"Breaking stale lock {self.lock_path} held by {state[0]}")
+                    self._break(state[0])
+                    observed = None
+                    continue
+            if self.timeout is not None and now - start > self.timeout:
+                raise LockTimeout(f"Could not acquire {self.lock_path} within {self.timeout} seconds")
+            time.sleep(self.poll_seconds)
+
+    def release(self):
+        if self._token is None:
+            return
+        self._stop_renewal.set()
+        self._renewal_thread.join()
+        if self._owner() == self._token:
+            os.remove(self.lock_path)
+        else:
+            _logger.warning(f"Lock {self.lock_path} was broken by another process while held")
+        self._token = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def _start_renewal(self):
+        self._stop_renewal = threading.Event()
+
+        def renew():
+            while not self._stop_renewal.wait(self.lease_seconds / 4):
+                try:
+                    os.utime(self.lock_path)
+                except FileNotFoundError:
+                    return
+
+        self._renewal_thread = threading.Thread(target=renew, daemon=True, name=f"lease {self.lock_path}")
+        self._renewal_thread.start()
+
+    def _owner(self):
+        try:
+            with open(self.lock_path) as f:
+                return json.load(f)['token']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _read_state(self):
+        try:
+            mtime = os.stat(self.lock_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return self._owner(), mtime
+
+    def _break(self, stale_owner):
+        # move the stale lock out of the way atomically, then make sure it was in fact the stale one
+        broken_path = f"{self.lock_path}.broken-{uuid.uuid4().hex}"
+        try:
+            os.rename(self.lock_path, broken_path)
+        except FileNotFoundError:
+            return
+        with open(broken_path) as f:
+            try:
+                owner = json.load(f).get('token')
+            except ValueError:
+                owner = None
+        if owner != stale_owner:  # another waiter broke the stale lock first and we moved its fresh lock
+            try:
+                os.link(broken_path, self.lock_path)
+            except FileExistsError:
+                pass
+        os.remove(broken_path)
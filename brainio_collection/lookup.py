@@ -1,9 +1,13 @@
+import csv
 import hashlib
+import json
 import logging
+import os
+import threading
+import uuid
 from pathlib import Path
 
-import numpy as np
-import pandas as pd
+from brainio_collection.locking import FileLock
 
 _logger = logging.getLogger(__name__)
 
@@ -11,43 +15,197 @@ TYPE_ASSEMBLY = 'assembly'
 TYPE_STIMULUS_SET = 'stimulus_set'
 
 path = Path(__file__).parent / "lookup.csv"
-_logger.debug(f"Loading lookup from {path}")
-print(f"Loading lookup from {path}")  # print because logging usually isn't set up at this point during import
-data = pd.read_csv(path)
+JOURNAL_SUFFIX = '.journal'
+COLUMNS = ['identifier', 'lookup_type', 'class', 'location_type', 'location', 'sha1', 'stimulus_set_identifier']
+
+
+class Catalog:
+    """
+    The lookup table of all stimulus sets and assemblies.
+    Rows come from a compacted csv file and an append-only journal next to it (`<csv>.journal`),
+    with one json-encoded row per line. New rows are only ever appended to the journal under a file lock,
+    so adding a row costs one small write and concurrent writers cannot lose each other's rows.
+    `compact` folds the journal into the csv file, e.g. with `brainio lookup compact` after packaging a batch.
+    Both files are committed and shipped with the package, so rows added by packaging are visible without compacting.
+    Both files are only read on first use, and rows are indexed by `(identifier, lookup_type)`.
+    Rows are dicts with one entry per column, missing values are None.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = Path(csv_path)
+        self.journal_path = Path(f"{csv_path}{JOURNAL_SUFFIX}")
+        self._rows = None
+        self._index = None
+        self._row_keys = None
+        self._journal_offset = 0
+        self._lock = threading.Lock()
+
+    def rows(self):
+        self._load()
+        return self._rows
+
+    def get(self, identifier, lookup_type):
+        self._load()
+        return list(self._index.get((identifier, lookup_type), []))
+
+    def identifiers(self, lookup_type):
+        return [row['identifier'] for row in self.rows() if row['lookup_type'] == lookup_type]
+
+    def add(self, row, validate=None):
+        """
+        Appends a row to the journal.
+        :param validate: called with the up-to-date catalog while the journal is locked, before the row is written.
+            Raise from it to reject the row, e.g. because it duplicates an existing row.
+        """
+        row = {column: row.get(column) for column in COLUMNS}
+        line = (json.dumps(row) + '\n').encode()
+        with self._file_lock():
+            with self._lock:
+                self._refresh()  # rows appended by other processes since the last read
+            if validate is not None:
+                validate(self)
+            file_descriptor = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(file_descriptor).st_size
+                if size > 0 and os.pread(file_descriptor, 1, size - 1) != b'\n':
+                    line = b'\n' + line  # terminate the torn line of a writer that crashed
+                os.write(file_descriptor, line)  # a single append of the whole line
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+            with self._lock:
+                self._refresh()
+
+    def export(self, csv_path):
+        """
+        Writes the compacted rows to `csv_path` in the csv lookup format.
+        """
+        csv_path = Path(csv_path)
+        temp_path = csv_path.with_name(f".{csv_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=COLUMNS, lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(self.rows())
+            os.replace(temp_path, csv_path)
+        except BaseException:
+            if temp_path.exists():
+                os.remove(temp_path)
+            raise
+
+    def compact(self):
+        """
+        Folds all journal rows into the csv file and empties the journal.
+        If interrupted between the two steps, the rows are in both files which the read view de-duplicates.
+        """
+        with self._file_lock():
+            with self._lock:
+                self._read_all()
+            self.export(self.csv_path)
+            with open(self.journal_path, 'wb'):
+                pass
+            with self._lock:
+                self._journal_offset = 0
+
+    def _file_lock(self):
+        return FileLock(f"{self.csv_path}.lock")
+
+    def _load(self):
+        if self._rows is not None:
+            return
+        with self._lock:
+            if self._rows is None:
+                self._read_all()
+
+    def _refresh(self):
+        if self._rows is None or not self._read_journal():
+            self._read_all()
+
+    def _read_all(self):
+        _logger.debug(f"Loading lookup from {self.csv_path}")
+        self._rows, self._index, self._row_keys = [], {}, set()
+        with open(self.csv_path, newline='') as f:
+            for row in csv.DictReader(f):
+                self._add_row({column: value or None for column, value in row.items()})
+        self._journal_offset = 0
+        self._read_journal()
+
+    def _read_journal(self):
+        """
+        Reads the journal rows that were appended since the last read.
+        :return: False if the journal was compacted in the meantime and everything needs to be re-read
+        """
+        try:
+            with open(self.journal_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self._journal_offset:
+                    return False
+                f.seek(self._journal_offset)
+                content = f.read()
+        except FileNotFoundError:
+            return self._journal_offset == 0
+        # leave out an unterminated last line: it is either still being written or was torn by a crash
+        content = content[:content.rfind(b'\n') + 1]
+        self._journal_offset += len(content)
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                _logger.warning(f"Skipping corrupt line in {self.journal_path}: {line}")
+                continue
+            self._add_row({column: row.get(column) for column in COLUMNS})
+        return True
+
+    def _add_row(self, row):
+        key = tuple(row[column] for column in COLUMNS)
+        if key in self._row_keys:
+            return
+        self._row_keys.add(key)
+        self._rows.append(row)
+        self._index.setdefault((row['identifier'], row['lookup_type']), []).append(row)
+
+
+catalog = Catalog(path)
+
+
+def __getattr__(name):
+    # the lookup table used to be a module-level DataFrame. Only build one (and import pandas) if asked for
+    if name == 'data':
+        import pandas as pd
+        return pd.DataFrame(catalog.rows(), columns=COLUMNS)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
 
 
 def list_stimulus_sets():
-    stimuli_rows = data[data['lookup_type'] == TYPE_STIMULUS_SET]
-    return stimuli_rows['identifier'].values
+    return catalog.identifiers(TYPE_STIMULUS_SET)
 
 
 def list_assemblies():
-    assembly_rows = data[data['lookup_type'] == TYPE_ASSEMBLY]
-    return assembly_rows['identifier'].values
+    return catalog.identifiers(TYPE_ASSEMBLY)
 
 
 def lookup_stimulus_set(identifier):
-    lookup = data[(data['identifier'] == identifier) & (data['lookup_type'] == TYPE_STIMULUS_SET)]
+    lookup = catalog.get(identifier, TYPE_STIMULUS_SET)
     if len(lookup) == 0:
         raise StimulusSetLookupError(f"stimulus_set {identifier} not found")
     if len(lookup) > 2:
         raise RuntimeError(
             f"Internal data inconsistency: Found more than 2 lookup rows for stimulus_set identifier {identifier}")
-    csv_lookup = [lookup_row for _, lookup_row in lookup.iterrows() if _is_csv_lookup(lookup_row)]
-    zip_lookup = [lookup_row for _, lookup_row in lookup.iterrows() if _is_zip_lookup(lookup_row)]
+    csv_lookup = [lookup_row for lookup_row in lookup if _is_csv_lookup(lookup_row)]
+    zip_lookup = [lookup_row for lookup_row in lookup if _is_zip_lookup(lookup_row)]
     assert len(csv_lookup) == 1 and len(zip_lookup) == 1
     csv_lookup, zip_lookup = csv_lookup[0], zip_lookup[0]
     return csv_lookup, zip_lookup
 
 
 def lookup_assembly(identifier):
-    lookup = data[(data['identifier'] == identifier) & (data['lookup_type'] == TYPE_ASSEMBLY)]
+    lookup = catalog.get(identifier, TYPE_ASSEMBLY)
     if len(lookup) == 0:
         raise AssemblyLookupError(f"assembly {identifier} not found")
     if len(lookup) > 1:
         raise RuntimeError(f"Internal data inconsistency: Found multiple lookup rows for identifier {identifier}")
-    lookup = lookup.squeeze()
-    return lookup
+    return lookup[0]
 
 
 class StimulusSetLookupError(KeyError):
@@ -60,43 +218,40 @@ class AssemblyLookupError(KeyError):
 
 def append(object_identifier, cls, lookup_type,
            bucket_name, sha1, s3_key, stimulus_set_identifier=None):
-    global data
     _logger.debug(f"Adding {lookup_type} {object_identifier} to lookup")
     object_lookup = {'identifier': object_identifier, 'lookup_type': lookup_type, 'class': cls,
                      'location_type': "S3", 'location': f"https://{bucket_name}.s3.amazonaws.com/{s3_key}",
                      'sha1': sha1, 'stimulus_set_identifier': stimulus_set_identifier, }
-    # check duplicates
     assert object_lookup['lookup_type'] in [TYPE_ASSEMBLY, TYPE_STIMULUS_SET]
-    duplicates = data[(data['identifier'] == object_lookup['identifier']) &
-                      (data['lookup_type'] == object_lookup['lookup_type'])]
-    if len(duplicates) > 0:
-        if object_lookup['lookup_type'] == TYPE_ASSEMBLY:
-            raise ValueError(f"Trying to add duplicate identifier {object_lookup['identifier']}, "
-                             f"existing \n{duplicates.to_string()}")
-        elif object_lookup['lookup_type'] == TYPE_STIMULUS_SET:
-            if len(duplicates) == 1 and duplicates.squeeze()['identifier'] == object_lookup['identifier'] and (
-                    (_is_csv_lookup(duplicates.squeeze()) and _is_zip_lookup(object_lookup)) or
-                    (_is_zip_lookup(duplicates.squeeze()) and _is_csv_lookup(object_lookup))):
-                pass  # all good, we're just adding the second part of a stimulus set
-            else:
-                raise ValueError(
-                    f"Trying to add duplicate identifier {object_lookup['identifier']}, existing {duplicates}")
-    # append and save
-    add_lookup = pd.DataFrame({key: [value] for key, value in object_lookup.items()})
-    data = data.append(add_lookup)
-    data.to_csv(path, index=False)
+
+    def check_duplicates(catalog):
+        duplicates = catalog.get(object_lookup['identifier'], object_lookup['lookup_type'])
+        if len(duplicates) > 0:
+            if object_lookup['lookup_type'] == TYPE_ASSEMBLY:
+                raise ValueError(f"Trying to add duplicate identifier {object_lookup['identifier']}, "
+                                 f"existing \n{duplicates}")
+            elif object_lookup['lookup_type'] == TYPE_STIMULUS_SET:
+                if len(duplicates) == 1 and duplicates[0]['identifier'] == object_lookup['identifier'] and (
+                        (_is_csv_lookup(duplicates[0]) and _is_zip_lookup(object_lookup)) or
+                        (_is_zip_lookup(duplicates[0]) and _is_csv_lookup(object_lookup))):
+                    pass  # all good, we're just adding the second part of a stimulus set
+                else:
+                    raise ValueError(
+                        f"Trying to add duplicate identifier {object_lookup['identifier']}, existing {duplicates}")
+
+    catalog.add(object_lookup, validate=check_duplicates)
 
 
 def _is_csv_lookup(data_row):
     return data_row['lookup_type'] == TYPE_STIMULUS_SET \
            and data_row['location'].endswith('.csv') \
-           and data_row['class'] not in [None, np.nan]
+           and data_row['class'] is not None
 
 
 def _is_zip_lookup(data_row):
     return data_row['lookup_type'] == TYPE_STIMULUS_SET \
            and data_row['location'].endswith('.zip') \
-           and data_row['class'] in [None, np.nan]
+           and data_row['class'] is None
 
 
 def sha1_hash(path, buffer_size=64 * 2 ** 10):
@@ -107,3 +262,4 @@ def sha1_hash(path, buffer_size=64 * 2 ** 10):
             sha1.update(buffer)
             buffer = f.read(buffer_size)
     return sha1.hexdigest()
+
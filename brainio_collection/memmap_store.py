@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import xarray as xr
+
+_logger = logging.getLogger(__name__)
+
+DATA_FILENAME = 'data.npy'
+COORDS_FILENAME = 'coords.nc'
+META_FILENAME = 'meta.json'
+
+_copy_block_bytes = 256 * 2 ** 20
+
+
+def memmap_store_path(netcdf_path):
+    return os.path.splitext(netcdf_path)[0] + '.memmap'
+
+
+def write_memmap_store(data_array, directory, sha1):
+    """
+    Writes a DataArray into a directory with a little-endian `.npy` blob of the values,
+    a small NetCDF file with only the coordinates and attributes, and a json file with dims and the source hash.
+    Values are copied in blocks along the first dimension so that lazily-opened arrays are never fully in memory.
+    The directory is assembled under a temporary name and only renamed into place once complete.
+    :param sha1: the hash of the file the values were read from, used to detect outdated stores
+    """
+    if data_array.dtype.kind not in 'biufc':
+        raise ValueError(f"Cannot memory-map values of dtype {data_array.dtype}")
+    temp_directory = f"{directory}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(temp_directory)
+    try:
+        dtype = data_array.dtype.newbyteorder('<')
+        values = np.lib.format.open_memmap(os.path.join(temp_directory, DATA_FILENAME), mode='w+',
+                                           dtype=dtype, shape=data_array.shape)
+        if data_array.ndim == 0:
+            values[...] = data_array.values
+        else:
+            first_dim = data_array.dims[0]
+            row_bytes = max(1, data_array.nbytes // max(1, data_array.shape[0]))
+            block_size = max(1, _copy_block_bytes // row_bytes)
+            for start in range(0, data_array.shape[0], block_size):
+                block = data_array.isel({first_dim: slice(start, start + block_size)})
+                values[start:start + block_size] = block.values
+        values.flush()
+        del values
+        coords = xr.Dataset(coords=data_array.coords, attrs=data_array.attrs)
+        coords.to_netcdf(os.path.join(temp_directory, COORDS_FILENAME))
+        with open(os.path.join(temp_directory, META_FILENAME), 'w') as f:
+            json.dump({'sha1': sha1, 'name': data_array.name, 'dims': list(data_array.dims)}, f)
+        if os.path.isdir(directory):  # outdated store
+            shutil.rmtree(directory)
+        os.rename(temp_directory, directory)
+    except BaseException:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+
+
+def open_memmap_store(directory, sha1=None):
+    """
+    Opens a store written by `write_memmap_store`.
+    Values are a read-only `np.memmap`, so all processes opening the same store share the same page-cache pages.
+    :param sha1: if given, stores built from a file with a different hash are treated as missing
+    :return: the DataArray, or None if there is no (up-to-date) store in `directory`
+    """
+    try:
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if sha1 is not None and meta['sha1'] != sha1:
+        _logger.debug(f"Memory-mapped store {directory} is outdated")
+        return None
+    values = np.load(os.path.join(directory, DATA_FILENAME), mmap_mode='r')
+    with xr.open_dataset(os.path.join(directory, COORDS_FILENAME)) as coords:
+        coords = coords.load()
+    return xr.DataArray(values, coords=coords.coords, dims=meta['dims'], name=meta['name'], attrs=coords.attrs)
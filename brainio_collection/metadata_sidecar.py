@@ -0,0 +1,98 @@
+import logging
+import os
+import uuid
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # pyarrow is optional: without it, stimulus set metadata is always parsed from the csv file
+    pa = feather = None
+
+_logger = logging.getLogger(__name__)
+
+SIDECAR_SUFFIX = '.feather'
+_csv_sha1_key = b'brainio_csv_sha1'
+# string columns with at most this fraction of distinct values are stored as categoricals
+_max_categorical_fraction = 0.5
+# declared dtypes of the identifying columns, so that e.g. numeric-looking image ids are not parsed as integers
+SCHEMA = {'image_id': str, 'filename': str}
+
+
+def sidecar_path(csv_path):
+    return os.path.splitext(csv_path)[0] + SIDECAR_SUFFIX
+
+
+def read_metadata(csv_path, csv_sha1=None, write_sidecar=True):
+    """
+    Reads stimulus set metadata, preferring the typed Feather sidecar of the csv file.
+    Both the csv file and the sidecar give the same typed table: the columns in `SCHEMA` have their declared dtype,
+    repetitive string columns are categorical, and all other columns are typed as `pd.read_csv` infers them.
+    :param csv_sha1: the SHA-1 hash of the csv file. Sidecars are only used if they were derived from a csv file with
+        this hash, and without a hash the csv file is always parsed.
+    :param write_sidecar: whether to write a sidecar after parsing the csv file, so that the next read can use it
+    :return: a `pd.DataFrame` of the metadata
+    """
+    path = sidecar_path(csv_path)
+    if csv_sha1 is not None:
+        table = read_sidecar(path, csv_sha1)
+        if table is not None:
+            return table
+    table = categorize(pd.read_csv(csv_path, dtype=SCHEMA))
+    if csv_sha1 is not None and write_sidecar and feather is not None:
+        try:
+            write_sidecar_file(table, path, csv_sha1)
+        except (OSError, pa.ArrowException) as e:  # the csv file can still be used, e.g. on a read-only file system
+            _logger.warning(f"Could not write metadata sidecar {path}: {e}")
+    return table
+
+
+def categorize(table):
+    """
+    :return: the table with repetitive string columns converted to categoricals
+    """
+    table = table.copy(deep=False)
+    for column in table.columns:
+        if column in SCHEMA or not (pd.api.types.is_object_dtype(table[column])
+                                                or pd.api.types.is_string_dtype(table[column])):
+            continue
+        if table[column].nunique(dropna=True) <= _max_categorical_fraction * len(table):
+            table[column] = table[column].astype('category')
+    return table
+
+
+def write_sidecar_file(table, path, csv_sha1):
+    """
+    Writes the typed table (see `read_metadata`) as a Feather file with an explicit schema,
+    recording the hash of the csv file it was derived from in the schema metadata.
+    """
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    arrow_table = arrow_table.replace_schema_metadata({**(arrow_table.schema.metadata or {}),
+                                                       _csv_sha1_key: csv_sha1.encode()})
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        feather.write_feather(arrow_table, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_sidecar(path, csv_sha1):
+    """
+    :return: the sidecar's table, or None if pyarrow is not installed, there is no sidecar,
+        or it was derived from a different csv file
+    """
+    if feather is None or not os.path.isfile(path):
+        return None
+    try:
+        arrow_table = feather.read_table(path)
+    except (OSError, pa.ArrowException) as e:
+        _logger.warning(f"Ignoring unreadable metadata sidecar {path}: {e}")
+        return None
+    if (arrow_table.schema.metadata or {}).get(_csv_sha1_key) != csv_sha1.encode():
+        _logger.debug(f"Metadata sidecar {path} is outdated")
+        return None
+    return arrow_table.to_pandas()
@@ -1,6 +1,9 @@
+import hashlib
 import logging
 import os
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
 import mimetypes
@@ -13,33 +16,75 @@ from PIL import Image
 import brainio_base.assemblies
 from brainio_collection import lookup, list_stimulus_sets
 from brainio_collection.lookup import TYPE_ASSEMBLY, TYPE_STIMULUS_SET, sha1_hash
+from brainio_collection.metadata_sidecar import SCHEMA, categorize, sidecar_path, write_sidecar_file
 
 _logger = logging.getLogger(__name__)
 
 
-def create_image_zip(proto_stimulus_set, target_zip_path):
+class _HashingWriter:
+    """
+    Write-only file wrapper that hashes all bytes as they are written.
+    It cannot seek, so `ZipFile` appends data descriptors instead of seeking back to patch headers,
+    and the hash covers exactly the bytes of the final file.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._position = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self._file.write(data)
+        self.sha1.update(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        self._file.flush()
+
+
+def _read_member(image_path, arcname):
+    return zipfile.ZipInfo.from_file(image_path, arcname=arcname), Path(image_path).read_bytes()
+
+
+def create_image_zip(proto_stimulus_set, target_zip_path, max_workers=None):
     """
     Create zip file for images in StimulusSet.
     Files in the zip will follow a flat directory structure with each row's filename equal to the `image_id` by default,
         or `image_path_within_store` if passed.
+    Images are stored without compression, and are read in a thread pool while earlier images are written.
+    The SHA1 hash is computed while writing the zip file.
     :param proto_stimulus_set: a `StimulusSet` with a `get_image: image_id -> local path` method, an `image_id` column,
         and optionally an `image_path_within_store` column.
     :param target_zip_path: path to write the zip file to
+    :param max_workers: number of threads reading images, defaults to `ThreadPoolExecutor`'s default
     :return: SHA1 hash of the zip file
     """
     _logger.debug(f"Zipping stimulus set to {target_zip_path}")
     os.makedirs(os.path.dirname(target_zip_path), exist_ok=True)
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    image_ids = proto_stimulus_set['image_id'].values
+    names = proto_stimulus_set['image_path_within_store'].values \
+        if 'image_path_within_store' in proto_stimulus_set.columns else image_ids
     arcnames = []
-    with zipfile.ZipFile(target_zip_path, 'w') as target_zip:
-        for _, row in proto_stimulus_set.iterrows():  # using iterrows instead of itertuples for very large StimulusSets
-            image_path = proto_stimulus_set.get_image(row['image_id'])
-            extension = os.path.splitext(image_path)[1]
-            arcname = row['image_path_within_store'] if hasattr(row, 'image_path_within_store') else row['image_id']
-            arcname = arcname + extension
-            target_zip.write(image_path, arcname=arcname)
-            arcnames.append(arcname)
-    sha1 = sha1_hash(target_zip_path)
-    return sha1, arcnames
+    with open(target_zip_path, 'wb') as target_file, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        writer = _HashingWriter(target_file)
+        with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED) as target_zip:
+            pending = deque()  # read-ahead of images in order, bounded to limit memory use
+            for image_id, name in tqdm(zip(image_ids, names), total=len(image_ids), desc="zip images"):
+                image_path = proto_stimulus_set.get_image(image_id)
+                extension = os.path.splitext(image_path)[1]
+                arcname = name + extension
+                arcnames.append(arcname)
+                pending.append(executor.submit(_read_member, image_path, arcname))
+                if len(pending) >= 4 * max_workers:
+                    target_zip.writestr(*pending.popleft().result())
+            while pending:
+                target_zip.writestr(*pending.popleft().result())
+    return writer.sha1.hexdigest(), arcnames
 
 
 def upload_to_s3(source_file_path, bucket_name, target_s3_key):
@@ -70,6 +115,21 @@ def create_image_csv(proto_stimulus_set, target_path):
     return sha1
 
 
+def create_metadata_sidecar(proto_stimulus_set, csv_path, csv_sha1):
+    """
+    Writes the typed metadata sidecar of the csv file (see `metadata_sidecar.read_metadata`), with the schema taken
+    from the dtypes of the proto stimulus set instead of being inferred from the csv file again.
+    :return: the path of the sidecar file
+    """
+    specific_stimulus_set = proto_stimulus_set[extract_specific(proto_stimulus_set)]
+    table = categorize(specific_stimulus_set.astype({column: dtype for column, dtype in SCHEMA.items()
+                                                     if column in specific_stimulus_set.columns}))
+    target_path = sidecar_path(csv_path)
+    _logger.debug(f"Writing metadata sidecar to {target_path}")
+    write_sidecar_file(table, target_path, csv_sha1)
+    return target_path
+
+
 def check_naming_convention(name):
     assert re.match(r"[a-z]+\.[A-Z][a-zA-Z0-9]+", name)
 
@@ -150,8 +210,10 @@ def package_stimulus_set(proto_stimulus_set, stimulus_set_identifier, bucket_nam
     assert 'filename' not in proto_stimulus_set.columns, "StimulusSet already has column 'filename'"
     proto_stimulus_set['filename'] = zip_filenames  # keep record of zip (or later local) filenames
     csv_sha1 = create_image_csv(proto_stimulus_set, str(target_csv_path))
-    # upload both to S3
+    target_sidecar_path = create_metadata_sidecar(proto_stimulus_set, str(target_csv_path), csv_sha1)
+    # upload to S3, the sidecar next to the csv where `fetch` looks for it
     upload_to_s3(str(target_csv_path), bucket_name, target_s3_key=csv_file_name)
+    upload_to_s3(target_sidecar_path, bucket_name, target_s3_key=os.path.basename(target_sidecar_path))
     upload_to_s3(str(target_zip_path), bucket_name, target_s3_key=zip_file_name)
     # link to csv and zip from same identifier. The csv however is the only one of the two rows with a class.
     lookup.append(object_identifier=stimulus_set_identifier, cls='StimulusSet',
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from brainio_collection import fetch
+from brainio_collection.lookup import AssemblyLookupError, lookup_assembly, lookup_stimulus_set
+
+_logger = logging.getLogger(__name__)
+
+_default_max_concurrency = int(os.getenv('BRAINIO_PREFETCH_CONCURRENCY', 4))
+
+
+class PrefetchReport:
+    def __init__(self, paths, num_files_fetched, num_bytes_fetched, seconds):
+        self.paths = paths  # location -> local path
+        self.num_files_fetched = num_files_fetched
+        self.num_bytes_fetched = num_bytes_fetched
+        self.seconds = seconds
+
+    @property
+    def bytes_per_second(self):
+        return self.num_bytes_fetched / self.seconds if self.seconds > 0 else 0.
+
+    def __repr__(self):
+        return (f"{type(self).__name__}({len(self.paths)} files, {self.num_files_fetched} fetched: "
+                f"{self.num_bytes_fetched / 2 ** 20:.1f} MiB in {self.seconds:.1f} s, "
+                f"{self.bytes_per_second / 2 ** 20:.1f} MiB/s)")
+
+
+def resolve_files(identifiers):
+    """
+    Resolves assembly and stimulus set identifiers to the files they need, including the stimulus sets of assemblies.
+    Stimulus sets that are shared between identifiers are only listed once.
+    :return: a dict of `{location: lookup row}`, and the locations of stimulus set zip files
+    """
+    files, zip_locations, stimulus_set_identifiers = {}, [], []
+    for identifier in identifiers:
+        try:
+            assembly_lookup = lookup_assembly(identifier)
+        except AssemblyLookupError:
+            stimulus_set_identifiers.append(identifier)
+            continue
+        files[assembly_lookup['location']] = assembly_lookup
+        stimulus_set_identifiers.append(assembly_lookup['stimulus_set_identifier'])
+    for stimulus_set_identifier in dict.fromkeys(stimulus_set_identifiers):
+        csv_lookup, zip_lookup = lookup_stimulus_set(stimulus_set_identifier)
+        files[csv_lookup['location']] = csv_lookup
+        files[zip_lookup['location']] = zip_lookup
+        zip_locations.append(zip_lookup['location'])
+    return files, zip_locations
+
+
+async def prefetch_async(identifiers, max_concurrency=None, extract=True):
+    """
+    Like `prefetch`, for callers that are already running an event loop.
+    """
+    max_concurrency = max_concurrency or _default_max_concurrency
+    files, zip_locations = resolve_files(identifiers)
+    _logger.info(f"Prefetching {len(files)} files for {len(identifiers)} identifiers")
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    # downloads share the connection pools in `download`, and hashing in the threads releases the GIL
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='prefetch') as executor:
+        results = await asyncio.gather(*[loop.run_in_executor(executor, _fetch, lookup)
+                                         for lookup in files.values()])
+        paths = {location: path for location, (path, _) in zip(files, results)}
+        if extract:
+            await asyncio.gather(*[loop.run_in_executor(executor, fetch.unzip, paths[location])
+                                   for location in zip_locations])
+    fetched_sizes = [size for _, size in results if size is not None]
+    report = PrefetchReport(paths, num_files_fetched=len(fetched_sizes), num_bytes_fetched=sum(fetched_sizes),
+                            seconds=time.monotonic() - start)
+    _logger.info(f"Prefetched {report}")
+    return report
+
+
+def prefetch(identifiers, max_concurrency=None, extract=True):
+    """
+    Fetches the files of many assemblies and stimulus sets concurrently, e.g. before a benchmark sweep.
+    The stimulus sets of assemblies are fetched as well, and every file is verified against its SHA-1 hash.
+    :param identifiers: assembly and/or stimulus set identifiers
+    :param max_concurrency: number of files fetched at the same time.
+        Defaults to the `BRAINIO_PREFETCH_CONCURRENCY` environment variable or 4.
+    :param extract: whether to also extract the stimulus set zip files
+    :return: a `PrefetchReport` with the local paths and the aggregate throughput of the files that were fetched
+    """
+    return asyncio.run(prefetch_async(identifiers, max_concurrency=max_concurrency, extract=extract))
+
+
+def _fetch(lookup):
+    """
+    :return: the local path, and the file's size if it was not yet present locally
+    """
+    path, hit = fetch._fetch_file(location_type=lookup['location_type'], location=lookup['location'],
+                                  sha1=lookup['sha1'])
+    return path, None if hit else os.path.getsize(path)
@@ -0,0 +1,93 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+_index_column = 'image_id'
+_axis_name = 'presentation'
+
+# attribute of a stimulus set holding the `image_id` values its index was built from, and the index
+_index_attribute = '_brainio_image_id_index'
+_stimulus_set_indexes_lock = threading.Lock()
+
+
+def stimulus_set_index(stimulus_set):
+    """
+    :return: a `pd.Index` mapping `image_id` to row position, built once per stimulus set and stored on it.
+        The index is rebuilt when the `image_id` column is reassigned.
+    """
+    values = stimulus_set[_index_column].values
+    with _stimulus_set_indexes_lock:
+        cached = stimulus_set.__dict__.get(_index_attribute)
+        if cached is None or _array_identity(cached[0]) != _array_identity(values):
+            index = pd.Index(values)
+            if not index.is_unique:
+                raise ValueError(f"StimulusSet {getattr(stimulus_set, 'identifier', None)} "
+                                 f"has duplicate {_index_column}s")
+            cached = (values, index)  # keeping the values alive, their memory cannot be reused by another column
+            object.__setattr__(stimulus_set, _index_attribute, cached)  # not a column
+        return cached[1]
+
+
+def _array_identity(values):
+    # every access to a column can return a new view onto the same buffer
+    if isinstance(values, np.ndarray):
+        return values.__array_interface__['data'][0], values.shape, values.strides, values.dtype
+    return id(values)
+
+
+@xr.register_dataarray_accessor('stimulus_set_meta')
+class StimulusSetMetaAccessor:
+    """
+    Virtual presentation coordinates for the columns of an assembly's `stimulus_set` (in `attrs`).
+    Columns are resolved on first access through the presentations' `image_id`s and then cached,
+    e.g. `assembly.stimulus_set_meta['category_name']`.
+    Use `materialize` to attach columns to the assembly as regular coordinates.
+    """
+
+    def __init__(self, assembly):
+        self._assembly = assembly
+        self._indexer = None
+        self._columns = {}
+
+    @property
+    def stimulus_set(self):
+        return self._assembly.attrs['stimulus_set']
+
+    def keys(self):
+        return list(self.stimulus_set.columns)
+
+    def __contains__(self, column):
+        return column in self.stimulus_set.columns
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            if column not in self:
+                raise KeyError(f"StimulusSet has no column {column}")
+            values = np.asarray(pd.api.extensions.take(self.stimulus_set[column].values, self._row_indexer(),
+                                                       allow_fill=True))
+            presentation = self._assembly[_axis_name]
+            self._columns[column] = xr.DataArray(values, coords=presentation.coords, dims=presentation.dims,
+                                                 name=column)
+        return self._columns[column]
+
+    def _row_indexer(self):
+        if self._indexer is None:
+            # position of every presentation's image in the stimulus set, -1 for images not in the stimulus set
+            self._indexer = stimulus_set_index(self.stimulus_set).get_indexer(self._assembly[_index_column].values)
+        return self._indexer
+
+    def materialize(self, columns=None):
+        """
+        :param columns: the stimulus set columns to attach, all columns that are not yet coordinates by default
+        :return: a new assembly with the columns as regular presentation coordinates
+        """
+        assembly = self._assembly
+        if columns is None:
+            columns = [column for column in self.keys() if column not in assembly.coords]
+        new_coords = {column: (_axis_name, self[column].values) for column in columns}
+        if isinstance(assembly.indexes.get(_axis_name), pd.MultiIndex):
+            # `assign_coords` cannot add levels to an existing MultiIndex: re-create the assembly from flat coordinates
+            return type(assembly)(assembly.reset_index(_axis_name).assign_coords(new_coords))
+        return assembly.assign_coords(new_coords)
@@ -1,15 +1,20 @@
 import numpy as np
+import pandas as pd
 
 # moved from brain-score.transformations to also use the subset algorithm for new data sets in brainio-contrib
 from brainio_base.assemblies import walk_coords
 
 
-def subset(source_assembly, target_assembly, subset_dims=None, dims_must_match=True, repeat=False):
+def subset(source_assembly, target_assembly, subset_dims=None, dims_must_match=True, repeat=False,
+           joint_levels=False):
     """
     Returns the subset of the source_assembly whose coordinates align with those specified by target_assembly.
     Ordering is not guaranteed.
     :param subset_dims: either dimensions, then all its levels will be used or levels right away
     :param dims_must_match:
+    :param joint_levels: if True, match the tuples of all levels of a dimension that the source assembly also has,
+        with a single selection per dimension. By default, levels are matched one after the other, which can select
+        more than the target when the levels are only unique jointly.
     :return:
     """
     subset_dims = subset_dims or target_assembly.dims
@@ -20,64 +25,114 @@ def subset(source_assembly, target_assembly, subset_dims=None, dims_must_match=T
         # as long as there is at least one level that we can select over
         levels = target_assembly[dim].variable.level_names or [dim]
         assert any(hasattr(source_assembly, level) for level in levels)
-        for level in levels:
-            if not hasattr(source_assembly, level):
-                continue
-            target_values = target_assembly[level].values
-            source_values = source_assembly[level].values
-            if repeat:
-                indexer = index_efficient(source_values, target_values)
-            else:
-                indexer = np.array([val in target_values for val in source_values])
-                indexer = np.where(indexer)[0]
-            if dim not in target_assembly.dims:
-                # not actually a dimension, but rather a coord -> filter along underlying dim
-                dim = target_assembly[dim].dims
-                assert len(dim) == 1
-                dim = dim[0]
-            dim_indexes = {_dim: slice(None) if _dim != dim else indexer for _dim in source_assembly.dims}
-            if len(np.unique(source_assembly.dims)) == len(source_assembly.dims):  # no repeated dimensions
-                source_assembly = source_assembly.isel(**dim_indexes)
-                continue
-            # work-around when dimensions are repeated. `isel` will keep only the first instance of a repeated dimension
-            positional_dim_indexes = [dim_indexes[dim] for dim in source_assembly.dims]
-            coords = {}
-            for coord, dims, value in walk_coords(source_assembly):
-                if len(dims) == 1:
-                    coords[coord] = (dims, value[dim_indexes[dims[0]]])
-                elif len(dims) == 0:
-                    coords[coord] = (dims, value)
-                elif len(set(dims)) == 1:
-                    coords[coord] = (dims, value[np.ix_(*[dim_indexes[dim] for dim in dims])])
-                else:
-                    raise NotImplementedError("cannot handle multiple dimensions")
-            source_assembly = type(source_assembly)(source_assembly.values[np.ix_(*positional_dim_indexes)],
-                                                    coords=coords, dims=source_assembly.dims)
+        levels = [level for level in levels if hasattr(source_assembly, level)]
+        if dim not in target_assembly.dims:
+            # not actually a dimension, but rather a coord -> filter along underlying dim
+            dim = target_assembly[dim].dims
+            assert len(dim) == 1
+            dim = dim[0]
+        if joint_levels:
+            source_values, target_values = _joint_codes(source_assembly, target_assembly, levels)
+            source_assembly = _select(source_assembly, dim, _indexer(source_values, target_values, repeat))
+        else:
+            for level in levels:
+                target_values = target_assembly[level].values
+                source_values = source_assembly[level].values
+                source_assembly = _select(source_assembly, dim, _indexer(source_values, target_values, repeat))
         if dims_must_match:
             # dims match up after selection. cannot compare exact equality due to potentially missing levels
             assert len(target_assembly[dim]) == len(source_assembly[dim])
     return source_assembly
 
 
+def _indexer(source_values, target_values, repeat):
+    if repeat:
+        return _index_efficient(source_values, target_values)
+    return index_isin(source_values, target_values)
+
+
+def _joint_codes(source_assembly, target_assembly, levels):
+    """
+    :return: integer codes of the tuples of `levels` values in the source and the target,
+        ordered like the tuples and comparable between source and target
+    """
+    source_values = [source_assembly[level].values for level in levels]
+    target_values = [target_assembly[level].values for level in levels]
+    source_keys, target_keys = pd.MultiIndex.from_arrays(source_values), pd.MultiIndex.from_arrays(target_values)
+    codes, _ = pd.factorize(source_keys.append(target_keys), sort=True)
+    source_codes, target_codes = codes[:len(source_keys)], codes[len(source_keys):]
+    # like `index_isin` for single levels, tuples with missing values match nothing.
+    # `factorize` gives them regular codes, so replace those with sentinels that differ between source and target
+    source_codes[np.logical_or.reduce([pd.isna(values) for values in source_values])] = -1
+    target_codes[np.logical_or.reduce([pd.isna(values) for values in target_values])] = -2
+    return source_codes, target_codes
+
+
+def _select(source_assembly, dim, indexer):
+    dim_indexes = {_dim: slice(None) if _dim != dim else indexer for _dim in source_assembly.dims}
+    if len(np.unique(source_assembly.dims)) == len(source_assembly.dims):  # no repeated dimensions
+        return source_assembly.isel(**dim_indexes)
+    # work-around when dimensions are repeated. `isel` will keep only the first instance of a repeated dimension
+    positional_dim_indexes = [dim_indexes[dim] for dim in source_assembly.dims]
+    coords = {}
+    for coord, dims, value in walk_coords(source_assembly):
+        if len(dims) == 1:
+            coords[coord] = (dims, value[dim_indexes[dims[0]]])
+        elif len(dims) == 0:
+            coords[coord] = (dims, value)
+        elif len(set(dims)) == 1:
+            coords[coord] = (dims, value[np.ix_(*[dim_indexes[dim] for dim in dims])])
+        else:
+            raise NotImplementedError("cannot handle multiple dimensions")
+    return type(source_assembly)(source_assembly.values[np.ix_(*positional_dim_indexes)],
+                                 coords=coords, dims=source_assembly.dims)
+
+
+def index_isin(source_values, target_values):
+    """
+    :return: the positions of all source values that occur in the target values, in source order.
+        Uses a hash table of the target values instead of testing membership value by value.
+    """
+    source_values = np.asarray(source_values)
+    matches = pd.Index(source_values).isin(target_values)
+    matches &= ~pd.isna(source_values)  # like `val in target_values`, missing values (NaN, None) match nothing
+    return np.flatnonzero(matches)
+
+
 def index_efficient(source_values, target_values):
-    source_sort_indices, target_sort_indices = np.argsort(source_values), np.argsort(target_values)
-    source_values, target_values = source_values[source_sort_indices], target_values[target_sort_indices]
-    indexer = []
-    source_index, target_index = 0, 0
-    while target_index < len(target_values) and source_index < len(source_values):
-        if source_values[source_index] == target_values[target_index]:
-            indexer.append(source_sort_indices[source_index])
-            # if next source value is greater than target, use next target. else next source.
-            # if target values remain the same, we might as well take the next target.
-            if (target_index + 1 < len(target_values) and
-                target_values[target_index + 1] == target_values[target_index]) or \
-                    (source_index + 1 < len(source_values) and
-                     source_values[source_index + 1] > target_values[target_index]):
-                target_index += 1
-            else:
-                source_index += 1
-        elif source_values[source_index] < target_values[target_index]:
-            source_index += 1
-        else:  # source_values[source_index] > target_values[target_index]:
-            target_index += 1
-    return indexer
+    """
+    :return: a list of source positions so that indexing the source with it yields every target value that is in the
+        source, as often as it occurs in the target, in sorted order.
+        A value that occurs more than once in the source is represented by all of its source positions.
+    """
+    return _index_efficient(source_values, target_values).tolist()
+
+
+def _index_efficient(source_values, target_values):
+    """
+    Vectorized version of walking the sorted source and target values in lockstep.
+    For every value that occurs `s` times in the source and `t` times in the target, the walk yields the first of the
+    value's sorted source positions `t - 1` times, followed by all `s` of its sorted source positions.
+    """
+    source_values, target_values = np.asarray(source_values), np.asarray(target_values)
+    source_sort_indices = np.argsort(source_values)
+    sorted_source, sorted_target = source_values[source_sort_indices], np.sort(target_values)
+    if len(sorted_source) == 0 or len(sorted_target) == 0:
+        return np.array([], dtype=source_sort_indices.dtype)
+    # runs of equal values in the sorted source. NaN is unequal to itself and thus matches nothing
+    run_starts = np.flatnonzero(np.concatenate([[True], sorted_source[1:] != sorted_source[:-1]]))
+    run_values = sorted_source[run_starts]
+    source_counts = np.diff(np.append(run_starts, len(sorted_source)))
+    target_counts = np.searchsorted(sorted_target, run_values, side='right') - \
+        np.searchsorted(sorted_target, run_values, side='left')
+    if sorted_source.dtype.kind in 'fc':
+        target_counts[np.isnan(run_values)] = 0
+    common = target_counts > 0
+    run_starts, source_counts, target_counts = run_starts[common], source_counts[common], target_counts[common]
+    # every common value's run in the output: t - 1 repeats of the first position, then all s positions
+    run_lengths = target_counts - 1 + source_counts
+    output_run_starts = np.cumsum(run_lengths) - run_lengths
+    offsets = np.arange(run_lengths.sum()) - np.repeat(output_run_starts, run_lengths)
+    positions = np.repeat(run_starts, run_lengths) + \
+        np.maximum(offsets - np.repeat(target_counts - 1, run_lengths), 0)
+    return source_sort_indices[positions]
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import uuid
+
+from brainio_collection.locking import FileLock
+
+_logger = logging.getLogger(__name__)
+
+# the index is compacted once it grows beyond this size
+_max_index_bytes = int(os.getenv('BRAINIO_VERIFICATION_INDEX_MAX_BYTES', 2 ** 20))
+
+
+def file_identity(filepath):
+    """
+    On-disk identity of a file: if none of these change, neither did the file's contents.
+    """
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
+class VerificationIndex:
+    """
+    Persistent record of files whose SHA-1 hash has already been verified.
+    Entries are keyed by the absolute file path and are only trusted as long as the file's
+    size, modification time and inode are unchanged since the hash was computed.
+    Processes sharing the index append their entries to it, so that none of them overwrites the others' entries.
+    Once the index grows beyond `BRAINIO_VERIFICATION_INDEX_MAX_BYTES`, it is compacted under a cross-process lock
+    to the latest entry of every file that still exists.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def verified_sha1(self, filepath):
+        """
+        :return: the previously verified SHA-1 of the file, or None if it was never verified or has changed since
+        """
+        try:
+            identity = file_identity(filepath)
+        except FileNotFoundError:
+            return None
+        path = os.path.abspath(filepath)
+        with self._lock:
+            entry = self._load().get(path)
+            if not _matches(entry, identity):  # might have been verified by another process meanwhile
+                self._entries = self._read()
+                entry = self._entries.get(path)
+        if not _matches(entry, identity):
+            return None
+        return entry['sha1']
+
+    def record(self, filepath, sha1):
+        entry = dict(file_identity(filepath), sha1=sha1)
+        path = os.path.abspath(filepath)
+        with self._lock:
+            self._load()[path] = entry
+            self._append(dict(entry, path=path))
+
+    def forget(self, filepath):
+        path = os.path.abspath(filepath)
+        with self._lock:
+            if self._load().pop(path, None) is not None:
+                self._append({'path': path, 'sha1': None})
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _read(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                return _parse_index(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _append(self, entry):
+        directory = os.path.dirname(self.index_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(file_descriptor, (json.dumps(entry) + '\n').encode())
+            index_size = os.fstat(file_descriptor).st_size
+        finally:
+            os.close(file_descriptor)
+        if index_size > _max_index_bytes:
+            with FileLock(self.index_path + '.lock'):
+                if os.path.getsize(self.index_path) > _max_index_bytes:  # not yet compacted by others
+                    self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the index with one line per file that still exists. Must be called with the index lock held.
+        Lines appended by other processes meanwhile are carried over.
+        """
+        with open(self.index_path, 'rb') as old_index:
+            entries = _parse_index(old_index.read())
+            temp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'w') as f:
+                for path, entry in entries.items():
+                    if os.path.exists(path):
+                        f.write(json.dumps(dict(entry, path=path)) + '\n')
+            os.replace(temp_path, self.index_path)
+            carried_over = old_index.read()
+        if carried_over:
+            file_descriptor = os.open(self.index_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(file_descriptor, carried_over)
+            finally:
+                os.close(file_descriptor)
+
+
+def _matches(entry, identity):
+    return entry is not None and all(entry[key] == value for key, value in identity.items())
+
+
+def _parse_index(data):
+    entries = {}
+    for line in data.decode().splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # torn line of a crashed writer
+        if 'path' not in entry:  # a whole index written before entries were appended, keyed by path
+            entries.update(entry)
+            continue
+        path = entry.pop('path')
+        if entry['sha1'] is None:
+            entries.pop(path, None)
+        else:
+            entries[path] = entry
+    return entries
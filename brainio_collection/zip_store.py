@@ -0,0 +1,96 @@
+import io
+import mmap
+import struct
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+
+_local_header = struct.Struct('<4s2B4HL2L2H')
+_local_header_signature = b'PK\x03\x04'
+
+
+class ZipImageStore:
+    """
+    Read-only access to the members of a zip file without extracting them.
+    The zip file is memory-mapped, and its central directory is parsed once into an index from member name to
+    compact arrays of header offsets and sizes. Reading a member is then a slice of the mapping,
+    so all processes reading the same zip file share the same page-cache pages.
+    Stored (uncompressed) and deflated members are supported.
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path, 'r') as zip_file:
+            members = [member for member in zip_file.infolist() if not member.is_dir()]
+        self._positions = {member.filename: position for position, member in enumerate(members)}
+        self._header_offsets = np.array([member.header_offset for member in members], dtype=np.int64)
+        self._compressed_sizes = np.array([member.compress_size for member in members], dtype=np.int64)
+        self._sizes = np.array([member.file_size for member in members], dtype=np.int64)
+        self._compress_types = np.array([member.compress_type for member in members], dtype=np.int16)
+        unsupported = set(self._compress_types) - {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}
+        if unsupported:
+            raise ValueError(f"{zip_path}: unsupported compression types {unsupported}")
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def names(self):
+        return list(self._positions)
+
+    def size(self, name):
+        return int(self._sizes[self._positions[name]])
+
+    def read(self, name):
+        """
+        :return: the uncompressed bytes of the member `name`
+        """
+        position = self._positions[name]
+        mapping = self._mapping()
+        header_offset = int(self._header_offsets[position])
+        signature, *_, name_length, extra_length = _local_header.unpack_from(mapping, header_offset)
+        if signature != _local_header_signature:
+            raise zipfile.BadZipFile(f"{self.zip_path}: bad local file header for {name}")
+        data_offset = header_offset + _local_header.size + name_length + extra_length
+        data = mapping[data_offset:data_offset + int(self._compressed_sizes[position])]
+        if self._compress_types[position] == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(data) != self._sizes[position]:
+            raise zipfile.BadZipFile(f"{self.zip_path}: {name} has {len(data)} bytes, expected {self._sizes[position]}")
+        return data
+
+    def open(self, name):
+        """
+        :return: a binary file-like object with the contents of the member `name`, e.g. for `PIL.Image.open`
+        """
+        return io.BytesIO(self.read(name))
+
+    def __getstate__(self):
+        # the memory mapping is re-created on first read after unpickling, e.g. in a data loader worker process
+        state = dict(self.__dict__)
+        state['_mmap'], state['_lock'] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+    def _mapping(self):
+        if self._mmap is None:
+            with self._lock:
+                if self._mmap is None:
+                    with open(self.zip_path, 'rb') as f:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
@@ -18,6 +18,10 @@ requirements = [
     "pytest",
     "Pillow",
     "imageio",
+    "moto",
+    "dask",
+    "pyarrow",
+    "hypothesis",
 ]
 
 setup(
@@ -31,6 +35,9 @@ setup(
     packages=find_packages(exclude=['tests', 'brainio_contrib']),
     include_package_data=True,
     install_requires=requirements,
+    entry_points={
+        'console_scripts': ['brainio=brainio_collection.cli:main'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='BrainIO',
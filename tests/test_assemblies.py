@@ -1,15 +1,22 @@
+import json
 import numpy as np
 import os
+import pandas as pd
 import pytest
 import xarray as xr
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pytest import approx
 
 import brainio_collection
 from brainio_base import assemblies
 from brainio_base.assemblies import DataAssembly
-from brainio_collection import fetch
+from brainio_base.stimuli import StimulusSet
+from brainio_collection import fetch, verification
+from brainio_collection.assembly_cache import AssemblyCache, assembly_nbytes
+from brainio_collection.memmap_store import open_memmap_store, write_memmap_store
+from brainio_collection.verification import VerificationIndex, file_identity
 
 
 @pytest.mark.parametrize('assembly', (
@@ -105,6 +112,55 @@ def test_load():
     print(assy_hvm)
 
 
+def test_load_lazy():
+    assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public", chunks={'neuroid': 16})
+    assert assy_hvm.chunks is not None
+    assert assy_hvm.shape == (256, 148480, 1)
+    assert 'category_name' in assy_hvm.coords
+    v4 = assy_hvm.sel(region='V4')
+    assert v4.chunks is not None  # still lazy after selection
+    v4 = v4.load()
+    assert v4.chunks is None
+    assert isinstance(v4, DataAssembly)
+
+
+def test_load_memmap():
+    assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public", backend='memmap',
+                                               use_cache=False)
+    assert isinstance(assy_hvm.variable.data, np.memmap)
+    assert assy_hvm.shape == (256, 148480, 1)
+    assert 'category_name' in assy_hvm.coords
+    netcdf_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public", use_cache=False)
+    np.testing.assert_array_equal(assy_hvm.values, netcdf_hvm.values)
+
+
+class TestMemmapStore:
+    def test_round_trip(self, tmp_path):
+        assembly = xr.DataArray(np.random.rand(5, 3).astype('>f4'), coords={
+            'image_id': ('presentation', [f"image{i}" for i in range(5)]),
+            'neuroid_id': ('neuroid', list(range(3)))}, dims=['presentation', 'neuroid'], attrs={'source': 'test'})
+        write_memmap_store(assembly, str(tmp_path / 'store'), sha1='abc')
+        loaded = open_memmap_store(str(tmp_path / 'store'), sha1='abc')
+        assert isinstance(loaded.variable.data, np.memmap)
+        assert loaded.dtype == np.dtype('<f4')
+        np.testing.assert_array_equal(loaded.values, assembly.values)
+        np.testing.assert_array_equal(loaded['image_id'].values, assembly['image_id'].values)
+        assert loaded.dims == assembly.dims
+        assert loaded.attrs['source'] == 'test'
+
+    def test_outdated(self, tmp_path):
+        assembly = xr.DataArray(np.zeros(3), coords={'image_id': ('presentation', [1, 2, 3])}, dims=['presentation'])
+        write_memmap_store(assembly, str(tmp_path / 'store'), sha1='abc')
+        assert open_memmap_store(str(tmp_path / 'store'), sha1='other') is None
+        assert open_memmap_store(str(tmp_path / 'missing')) is None
+
+    def test_object_values_rejected(self, tmp_path):
+        assembly = xr.DataArray(np.array(['a', 'b'], dtype=object), dims=['presentation'])
+        with pytest.raises(ValueError):
+            write_memmap_store(assembly, str(tmp_path / 'store'), sha1='abc')
+        assert not (tmp_path / 'store').exists()
+
+
 def test_repr():
     assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public")
     repr_hvm = repr(assy_hvm)
@@ -130,6 +186,14 @@ def test_lookup():
     assert assy['location'] == hvm_s3_url
 
 
+def test_lookup_stimulus_set():
+    csv_lookup, zip_lookup = brainio_collection.lookup.lookup_stimulus_set("dicarlo.hvm-public")
+    assert csv_lookup['class'] == 'StimulusSet'
+    assert csv_lookup['location'].endswith('.csv')
+    assert zip_lookup['class'] is None
+    assert zip_lookup['location'].endswith('.zip')
+
+
 def test_lookup_bad_name():
     with pytest.raises(brainio_collection.lookup.AssemblyLookupError):
         brainio_collection.lookup.lookup_assembly("BadName")
@@ -143,6 +207,66 @@ def test_fetch():
     assert os.path.exists(local_path)
 
 
+class TestVerificationIndex:
+    def test_unchanged_file_skips_hash(self, tmp_path):
+        filepath = tmp_path / 'file.txt'
+        filepath.write_text('content')
+        index = VerificationIndex(str(tmp_path / 'index.json'))
+        assert index.verified_sha1(str(filepath)) is None
+        index.record(str(filepath), 'abc')
+        assert VerificationIndex(str(tmp_path / 'index.json')).verified_sha1(str(filepath)) == 'abc'
+
+    def test_changed_file_not_trusted(self, tmp_path):
+        filepath = tmp_path / 'file.txt'
+        filepath.write_text('content')
+        index = VerificationIndex(str(tmp_path / 'index.json'))
+        index.record(str(filepath), 'abc')
+        filepath.write_text('changed content')
+        assert index.verified_sha1(str(filepath)) is None
+
+    def test_strict_rehashes(self, tmp_path, monkeypatch):
+        filepath = tmp_path / 'file.txt'
+        filepath.write_text('content')
+        monkeypatch.setattr(fetch, 'verification_index', VerificationIndex(str(tmp_path / 'index.json')))
+        fetch.verification_index.record(str(filepath), 'wrong-sha1')
+        fetch.verify_sha1(str(filepath), 'wrong-sha1')  # trusted from index
+        with pytest.raises(IOError):
+            fetch.verify_sha1(str(filepath), 'wrong-sha1', strict=True)
+
+    def test_concurrent_writers_keep_all_entries(self, tmp_path):
+        filepaths = [tmp_path / f"file{number}.txt" for number in range(40)]
+        for filepath in filepaths:
+            filepath.write_text(filepath.name)
+        indexes = [VerificationIndex(str(tmp_path / 'index.json')) for _ in range(4)]  # e.g. one per process
+        with ThreadPoolExecutor(len(indexes)) as executor:
+            list(executor.map(lambda number: indexes[number % len(indexes)].record(str(filepaths[number]), str(number)),
+                              range(len(filepaths))))
+        index = VerificationIndex(str(tmp_path / 'index.json'))
+        assert [index.verified_sha1(str(filepath)) for filepath in filepaths] == [str(number) for number in range(40)]
+
+    def test_compaction(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(verification, '_max_index_bytes', 1000)
+        filepath, removed = tmp_path / 'file.txt', tmp_path / 'removed.txt'
+        filepath.write_text('content')
+        removed.write_text('content')
+        index = VerificationIndex(str(tmp_path / 'index.json'))
+        index.record(str(removed), 'abc')
+        removed.unlink()
+        for number in range(20):
+            index.record(str(filepath), str(number))
+        assert os.path.getsize(tmp_path / 'index.json') <= 1000
+        index = VerificationIndex(str(tmp_path / 'index.json'))
+        assert index.verified_sha1(str(filepath)) == '19'
+        assert str(removed) not in index._load()
+
+    def test_reads_whole_index(self, tmp_path):
+        filepath = tmp_path / 'file.txt'
+        filepath.write_text('content')
+        whole_index = {str(filepath): dict(file_identity(str(filepath)), sha1='abc')}
+        (tmp_path / 'index.json').write_text(json.dumps(whole_index))
+        assert VerificationIndex(str(tmp_path / 'index.json')).verified_sha1(str(filepath)) == 'abc'
+
+
 def test_wrap():
     assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public")
     hvm_v3 = assy_hvm.sel(variation=3)
@@ -176,6 +300,75 @@ def test_multi_group():
     assert "object_name" in hvm_it_v3_obj.indexes["presentation"].names
 
 
+class TestMergeStimulusSetMeta:
+    def test_columns_aligned_by_image_id(self):
+        stimulus_set = StimulusSet(pd.DataFrame({'image_id': ['a', 'b', 'c'], 'label': [1, 2, 3],
+                                                 'category': ['x', 'y', 'z']}))
+        assembly = xr.DataArray(np.zeros((4, 2)), coords={
+            'image_id': ('presentation', ['c', 'a', 'a', 'd']),
+            'category': ('presentation', ['own', 'own', 'own', 'own'])}, dims=['presentation', 'choice'])
+        loader = fetch.AssemblyLoader(local_path=None, stimulus_set_identifier='test', cls='BehavioralAssembly')
+        merged = loader.merge_stimulus_set_meta(assembly, stimulus_set)
+        np.testing.assert_array_equal(merged['label'].values[:3], [3, 1, 1])
+        assert np.isnan(merged['label'].values[3])  # image not in stimulus set
+        # existing presentation coordinates are kept
+        np.testing.assert_array_equal(merged['category'].values, ['own'] * 4)
+
+    def test_duplicate_image_ids(self):
+        stimulus_set = StimulusSet(pd.DataFrame({'image_id': ['a', 'a'], 'label': [1, 2]}))
+        assembly = xr.DataArray(np.zeros(1), coords={'image_id': ('presentation', ['a'])}, dims=['presentation'])
+        loader = fetch.AssemblyLoader(local_path=None, stimulus_set_identifier='test', cls='BehavioralAssembly')
+        with pytest.raises(ValueError):
+            loader.merge_stimulus_set_meta(assembly, stimulus_set)
+
+    @pytest.mark.parametrize('image_ids', [['a', 'b', 'c'], [10, 11, 12]])
+    def test_image_ids_reassigned(self, image_ids):
+        stimulus_set = StimulusSet(pd.DataFrame({'image_id': image_ids, 'label': [1, 2, 3]}))
+        assembly = xr.DataArray(np.zeros(2), coords={'image_id': ('presentation', image_ids[:2])},
+                                dims=['presentation'])
+        loader = fetch.AssemblyLoader(local_path=None, stimulus_set_identifier='test', cls='BehavioralAssembly')
+        np.testing.assert_array_equal(loader.merge_stimulus_set_meta(assembly, stimulus_set)['label'].values, [1, 2])
+        stimulus_set['image_id'] = image_ids[::-1]
+        np.testing.assert_array_equal(loader.merge_stimulus_set_meta(assembly, stimulus_set)['label'].values, [3, 2])
+
+
+class TestLazyStimulusSetMeta:
+    def _assembly(self):
+        stimulus_set = StimulusSet(pd.DataFrame({'image_id': ['a', 'b', 'c'], 'label': [1, 2, 3]}))
+        assembly = DataAssembly(np.zeros((4, 2)), coords={
+            'image_id': ('presentation', ['c', 'a', 'a', 'b']),
+            'repetition': ('presentation', [0, 0, 1, 0]),
+            'neuroid_id': ('neuroid', [0, 1])}, dims=['presentation', 'neuroid'])
+        assembly.attrs['stimulus_set'] = stimulus_set
+        return assembly
+
+    def test_resolve_column(self):
+        assembly = self._assembly()
+        assert 'label' not in assembly.coords
+        assert 'label' in assembly.stimulus_set_meta
+        np.testing.assert_array_equal(assembly.stimulus_set_meta['label'].values, [3, 1, 1, 2])
+
+    def test_resolve_after_selection(self):
+        assembly = self._assembly()
+        second_repetition = assembly.sel(repetition=1)
+        np.testing.assert_array_equal(second_repetition.stimulus_set_meta['label'].values, [1])
+
+    def test_materialize(self):
+        assembly = self._assembly().stimulus_set_meta.materialize(['label'])
+        assert isinstance(assembly, DataAssembly)
+        np.testing.assert_array_equal(assembly['label'].values, [3, 1, 1, 2])
+        assert 'label' in assembly.indexes['presentation'].names
+
+    def test_get_assembly(self):
+        assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public",
+                                                   lazy_stimulus_set_meta=True)
+        assert 'category_name' not in assy_hvm.coords
+        category_names = assy_hvm.stimulus_set_meta['category_name']
+        assert len(category_names) == len(assy_hvm['presentation'])
+        eager_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public")
+        np.testing.assert_array_equal(category_names.values, eager_hvm['category_name'].values)
+
+
 def test_stimulus_set_from_assembly():
     assy_hvm = brainio_collection.get_assembly(identifier="dicarlo.MajajHong2015.public")
     stimulus_set = assy_hvm.attrs["stimulus_set"]
@@ -371,3 +564,88 @@ class TestMarques2020V1Properties:
         assert set(assembly['neuronal_property'].values) == set(properties)
         assert assembly.stimulus_set is not None
         assert assembly.stimulus_set.identifier == stimulus_set_identifier
+
+
+class TestAssemblyCache:
+    def _assembly(self, num_presentations=10):
+        return DataAssembly(np.random.rand(num_presentations, 3), coords={
+            'image_id': ('presentation', list(range(num_presentations))),
+            'neuroid_id': ('neuroid', list(range(3)))}, dims=['presentation', 'neuroid'])
+
+    def test_hit(self):
+        cache = AssemblyCache(max_bytes=2 ** 20)
+        assembly = self._assembly()
+        cache.put(('a', 'sha1'), assembly)
+        cached = cache.get(('a', 'sha1'))
+        assert cached is not None
+        np.testing.assert_array_equal(cached.values, assembly.values)
+        assert cache.get(('a', 'other-sha1')) is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_attrs_isolated(self):
+        cache = AssemblyCache(max_bytes=2 ** 20)
+        cache.put(('a', 'sha1'), self._assembly())
+        first = cache.get(('a', 'sha1'))
+        first.attrs['stimulus_set_identifier'] = 'corrupted'
+        second = cache.get(('a', 'sha1'))
+        assert 'stimulus_set_identifier' not in second.attrs
+
+    def test_values_read_only(self):
+        cache = AssemblyCache(max_bytes=2 ** 20)
+        assembly = self._assembly()
+        expected = assembly.values.copy()
+        cache.put(('a', 'sha1'), assembly)
+        first = cache.get(('a', 'sha1'))
+        with pytest.raises(ValueError):
+            first.values -= 5
+        with pytest.raises(ValueError):
+            first['image_id'].values[0] = -1
+        np.testing.assert_array_equal(cache.get(('a', 'sha1')).values, expected)
+
+    def test_stimulus_set_isolated(self):
+        cache = AssemblyCache(max_bytes=2 ** 20)
+        assembly = self._assembly()
+        assembly.attrs['stimulus_set'] = StimulusSet({'image_id': [0, 1], 'x': [1, 2]})
+        cache.put(('a', 'sha1'), assembly)
+        first = cache.get(('a', 'sha1'))
+        first.attrs['stimulus_set']['y'] = 3
+        try:
+            first.attrs['stimulus_set'].loc[0, 'x'] = 99  # the shared buffer is read-only unless pandas copies on write
+        except ValueError:
+            pass
+        second = cache.get(('a', 'sha1'))
+        assert second.attrs['stimulus_set']['x'].tolist() == [1, 2]
+        assert 'y' not in second.attrs['stimulus_set']
+
+    def test_stimulus_set_size(self):
+        assembly = self._assembly()
+        nbytes = assembly_nbytes(assembly)
+        assembly.attrs['stimulus_set'] = StimulusSet({'image_id': [f"image{i}" for i in range(10)]})
+        assert assembly_nbytes(assembly) > nbytes + 10 * len('image0')
+
+    def test_lru_eviction(self):
+        assembly = self._assembly()
+        cache = AssemblyCache(max_bytes=2 * assembly_nbytes(assembly))
+        cache.put('a', assembly)
+        cache.put('b', self._assembly())
+        cache.get('a')  # mark `a` as recently used
+        cache.put('c', self._assembly())
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+        assert cache.stats()['evictions'] == 1
+
+    def test_too_large_not_cached(self):
+        assembly = self._assembly(num_presentations=100)
+        cache = AssemblyCache(max_bytes=assembly_nbytes(assembly) - 1)
+        assert cache.put('a', assembly) is assembly
+        assert cache.get('a') is None
+
+    def test_get_assembly_cached(self):
+        first = brainio_collection.get_assembly('dicarlo.MajajHong2015.public', use_cache=True)
+        hits = fetch.assembly_cache.stats()['hits']
+        second = brainio_collection.get_assembly('dicarlo.MajajHong2015.public', use_cache=True)
+        assert fetch.assembly_cache.stats()['hits'] == hits + 1
+        assert first.shape == second.shape
+        assert second.attrs['identifier'] == 'dicarlo.MajajHong2015.public'
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from brainio_collection import cache_manager, fetch
+from brainio_collection.cache_manager import DiskCache
+
+
+def make_artifact(root, name, size, files=1):
+    directory = root / name
+    directory.mkdir(parents=True)
+    for number in range(files):
+        (directory / f"file{number}").write_bytes(b'0' * (size // files))
+    return directory
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(str(tmp_path))
+
+
+class TestArtifacts:
+    def test_sizes_include_subdirectories(self, tmp_path, cache):
+        directory = make_artifact(tmp_path, 'image_test', 100)
+        (directory / 'images').mkdir()
+        (directory / 'images' / 'image1.png').write_bytes(b'0' * 50)
+        (tmp_path / '.locks').mkdir()
+        artifacts = cache.artifacts()
+        assert [artifact['name'] for artifact in artifacts] == ['image_test']
+        assert artifacts[0]['size'] == 150
+
+    def test_access_counts(self, tmp_path, cache):
+        make_artifact(tmp_path, 'assy_test', 10)
+        cache.record_access('assy_test', hit=False)
+        cache.record_access('assy_test', hit=True)
+        cache.record_access('assy_test', hit=True)
+        artifact, = cache.artifacts()
+        assert (artifact['hits'], artifact['misses']) == (2, 1)
+
+    def test_recorded_sizes_are_not_rescanned(self, tmp_path, cache):
+        directory = make_artifact(tmp_path, 'image_test', 100)
+        assert cache.artifacts()[0]['size'] == 100  # scanned once
+        (directory / 'image1.png').write_bytes(b'0' * 50)
+        assert cache.artifacts()[0]['size'] == 100
+        cache.record_size('image_test', 'extracted', 50)
+        cache.record_size('image_test', 'extracted', 60)
+        assert cache.artifacts()[0]['size'] == 160
+
+    def test_ignores_torn_log_line(self, tmp_path, cache):
+        make_artifact(tmp_path, 'assy_test', 10)
+        cache.record_access('assy_test', hit=True)
+        with open(cache.access_log_path, 'a') as f:
+            f.write('{"name": "assy_te')
+        assert cache.access_stats()['assy_test']['hits'] == 1
+
+
+class TestPrune:
+    def test_lru(self, tmp_path, cache):
+        for name in ['a', 'b', 'c']:
+            make_artifact(tmp_path, name, 100)
+        for name in ['b', 'a', 'c']:
+            cache.record_access(name, hit=True)
+        evicted = cache.prune(200)
+        assert [artifact['name'] for artifact in evicted] == ['b']
+        assert sorted(os.listdir(tmp_path)) == ['.access_log', '.locks', 'a', 'c']
+        assert set(cache.access_stats()) == {'a', 'c'}
+
+    def test_lfu(self, tmp_path, cache):
+        for name in ['a', 'b']:
+            make_artifact(tmp_path, name, 100)
+        cache.record_access('b', hit=True)
+        for _ in range(3):
+            cache.record_access('a', hit=True)
+        evicted = cache.prune(100, policy='lfu')
+        assert [artifact['name'] for artifact in evicted] == ['b']
+
+    def test_dry_run(self, tmp_path, cache):
+        make_artifact(tmp_path, 'a', 100)
+        evicted = cache.prune(0, dry_run=True)
+        assert [artifact['name'] for artifact in evicted] == ['a']
+        assert os.path.isdir(tmp_path / 'a')
+
+    def test_unknown_policy(self, cache):
+        with pytest.raises(ValueError):
+            cache.prune(0, policy='random')
+
+    def test_skips_own_pin(self, tmp_path, cache):
+        make_artifact(tmp_path, 'a', 100)
+        make_artifact(tmp_path, 'b', 100)
+        cache.pin('a')
+        evicted = cache.prune(0)
+        assert [artifact['name'] for artifact in evicted] == ['b']
+        assert os.path.isdir(tmp_path / 'a')
+
+    def test_pinned_context(self, tmp_path, cache):
+        make_artifact(tmp_path, 'a', 100)
+        with cache.pinned('a'):
+            with cache.pinned('a'):
+                pass
+            assert cache.prune(0) == []
+        assert not cache.is_pinned('a')
+        assert [artifact['name'] for artifact in cache.prune(0)] == ['a']
+
+    def test_ignores_pin_of_dead_process(self, tmp_path, cache):
+        make_artifact(tmp_path, 'a', 100)
+        process = subprocess.run([sys.executable, '-c', "import os; print(os.getpid())"],
+                                 capture_output=True, text=True, check=True)
+        pin_directory = tmp_path / '.pins' / 'a'
+        pin_directory.mkdir(parents=True)
+        (pin_directory / f"{cache_manager.socket.gethostname()}-{process.stdout.strip()}").touch()
+        assert not cache.is_pinned('a')
+        assert [artifact['name'] for artifact in cache.prune(0)] == ['a']
+
+    def test_honors_recent_pin_of_other_host(self, tmp_path, cache):
+        make_artifact(tmp_path, 'a', 100)
+        pin_directory = tmp_path / '.pins' / 'a'
+        pin_directory.mkdir(parents=True)
+        (pin_directory / 'some-other-host-1234').touch()
+        assert cache.prune(0) == []
+
+
+def test_fetch_file_records_accesses_and_enforces_quota(tmp_path, monkeypatch):
+    home = tmp_path / 'brainio_home'
+    monkeypatch.setattr(fetch, '_local_data_path', str(home))
+    monkeypatch.setattr(fetch, 'verification_index', fetch.VerificationIndex(str(tmp_path / 'index.json')))
+    monkeypatch.setattr(cache_manager, '_default_max_bytes', 50)
+    make_artifact(home, 'assy_old', 100)
+    source = tmp_path / 'assy_test_new.nc'
+    source.write_bytes(b'1' * 100)
+    sha1 = hashlib.sha1(source.read_bytes()).hexdigest()
+    for _ in range(2):
+        fetch.fetch_file(location_type='file', location=source.as_uri(), sha1=sha1)
+    artifacts = {artifact['name']: artifact for artifact in DiskCache(str(home)).artifacts()}
+    name = fetch.local_directory_name(source.as_uri(), sha1)
+    assert set(artifacts) == {name}  # the old artifact was evicted, the fetched one was pinned while fetching
+    assert (artifacts[name]['hits'], artifacts[name]['misses']) == (1, 1)
+    assert not artifacts[name]['pinned']
+
+
+def test_cli_prune(tmp_path, capsys):
+    from brainio_collection.cli import main
+    make_artifact(tmp_path, 'a', 100)
+    main(['cache', '--root', str(tmp_path), 'stats'])
+    assert '1 artifacts, 100 bytes' in capsys.readouterr().out
+    main(['cache', '--root', str(tmp_path), 'prune', '0'])
+    assert not os.path.exists(tmp_path / 'a')
+
+
+def test_prune_removes_unlinked_blobs(tmp_path, cache):
+    blob = tmp_path / '.blobs' / 'ab' / 'abcdef'
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(b'0' * 100)
+    directory = make_artifact(tmp_path, 'a', 0, files=0)
+    os.link(blob, directory / 'assy_a.nc')
+    make_artifact(tmp_path, 'b', 10)
+    cache.prune(100)
+    assert blob.exists()  # still linked from artifact a
+    cache.prune(0)
+    assert not blob.exists()
+
+
+def test_fetch_file_hit_for_nested_output(tmp_path, monkeypatch):
+    class NestedFetcher(fetch.LocalFetcher):  # like S3 keys with prefixes, the file is not at the top of its directory
+        def __init__(self, location, local_filename, sha1=None):
+            super(NestedFetcher, self).__init__(location, local_filename, sha1=sha1)
+            os.makedirs(os.path.join(self.local_dir_path, 'prefix'), exist_ok=True)
+            self.output_filename = os.path.join(self.local_dir_path, 'prefix', os.path.basename(self.source_path))
+
+    home = tmp_path / 'brainio_home'
+    monkeypatch.setattr(fetch, '_local_data_path', str(home))
+    monkeypatch.setattr(fetch, 'verification_index', fetch.VerificationIndex(str(tmp_path / 'index.json')))
+    monkeypatch.setattr(fetch, '_fetcher_types', dict(fetch._fetcher_types))
+    fetch.register_fetcher('nested', NestedFetcher)
+    source = tmp_path / 'assy_test.nc'
+    source.write_bytes(b'1' * 100)
+    sha1 = hashlib.sha1(source.read_bytes()).hexdigest()
+    hits = [fetch._fetch_file('nested', source.as_uri(), sha1)[1] for _ in range(2)]
+    assert hits == [False, True]
+
+
+def test_access_log_compacted_without_quota(tmp_path, cache, monkeypatch):
+    monkeypatch.setattr(cache_manager, '_max_access_log_bytes', 1000)
+    make_artifact(tmp_path, 'assy_test', 10)
+    for _ in range(100):
+        cache.record_access('assy_test', hit=True)
+    assert os.path.getsize(cache.access_log_path) <= 1000
+    assert cache.access_stats()['assy_test']['hits'] == 100
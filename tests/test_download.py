@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from brainio_collection import download
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    # clients created outside of the mock would talk to the real S3
+    monkeypatch.setattr(download, '_clients', {})
+    monkeypatch.setattr(download, '_bucket_signed', {})
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='brainio-test')
+        yield client
+
+
+class TestDownloadS3Object:
+    @pytest.mark.parametrize('size', [0, 1, 2 ** 10, 3 * 2 ** 20 + 7])
+    def test_content_and_sha1(self, s3_bucket, tmp_path, size):
+        content = os.urandom(size)
+        s3_bucket.put_object(Bucket='brainio-test', Key='assy_test.nc', Body=content)
+        target_path = tmp_path / 'assy_test.nc'
+        sha1 = download.download_s3_object('brainio-test', 'assy_test.nc', str(target_path),
+                                           part_size=2 ** 18, max_concurrency=4)
+        assert target_path.read_bytes() == content
+        assert sha1 == hashlib.sha1(content).hexdigest()
+
+    def test_remembers_access_mode(self, s3_bucket, tmp_path):
+        s3_bucket.put_object(Bucket='brainio-test', Key='image_test.csv', Body=b'image_id\n1\n')
+        download.download_s3_object('brainio-test', 'image_test.csv', str(tmp_path / 'image_test.csv'))
+        assert download._bucket_signed[(None, 'brainio-test')] is True
+
+    def test_missing_object(self, s3_bucket, tmp_path):
+        with pytest.raises(Exception):
+            download.download_s3_object('brainio-test', 'missing.nc', str(tmp_path / 'missing.nc'))
+
+
+class TestResume:
+    def test_resumes_from_manifest(self, s3_bucket, tmp_path, monkeypatch):
+        content = os.urandom(4 * 2 ** 18)
+        s3_bucket.put_object(Bucket='brainio-test', Key='assy_test.nc', Body=content)
+        etag = s3_bucket.head_object(Bucket='brainio-test', Key='assy_test.nc')['ETag']
+        target_path = tmp_path / 'assy_test.nc'
+        # simulate an interrupted download that completed the first two parts
+        partial_content = bytearray(len(content))
+        partial_content[:2 * 2 ** 18] = content[:2 * 2 ** 18]
+        (tmp_path / ('assy_test.nc' + download.PARTIAL_SUFFIX)).write_bytes(bytes(partial_content))
+        (tmp_path / ('assy_test.nc' + download.MANIFEST_SUFFIX)).write_text(json.dumps(
+            {'etag': etag, 'size': len(content), 'part_size': 2 ** 18, 'completed_parts': [0, 1]}))
+        requested_offsets = []
+        get_range = download._get_range
+
+        def recording_get_range(client, bucket, key, offset, length, etag=None):
+            requested_offsets.append(offset)
+            return get_range(client, bucket, key, offset, length, etag=etag)
+
+        monkeypatch.setattr(download, '_get_range', recording_get_range)
+        sha1 = download.download_s3_object('brainio-test', 'assy_test.nc', str(target_path),
+                                           sha1=hashlib.sha1(content).hexdigest())
+        assert sorted(requested_offsets) == [2 * 2 ** 18, 3 * 2 ** 18]
+        assert target_path.read_bytes() == content
+        assert sha1 == hashlib.sha1(content).hexdigest()
+        assert os.listdir(tmp_path) == ['assy_test.nc']
+
+    def test_invalid_sha1_not_moved_into_place(self, s3_bucket, tmp_path):
+        s3_bucket.put_object(Bucket='brainio-test', Key='assy_test.nc', Body=b'content')
+        target_path = tmp_path / 'assy_test.nc'
+        with pytest.raises(IOError):
+            download.download_s3_object('brainio-test', 'assy_test.nc', str(target_path), sha1='0' * 40)
+        assert not target_path.exists()
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,179 @@
+import hashlib
+import http.server
+import os
+import threading
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from brainio_collection import fetch
+
+
+@pytest.fixture
+def local_data_path(tmp_path, monkeypatch):
+    local_data_path = tmp_path / 'brainio_home'
+    monkeypatch.setattr(fetch, '_local_data_path', str(local_data_path))
+    monkeypatch.setattr(fetch, 'verification_index', fetch.VerificationIndex(str(local_data_path / 'index.json')))
+    return local_data_path
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = tmp_path / 'mirror' / 'brainio-test'
+    mirror.mkdir(parents=True)
+    content = os.urandom(2 ** 12)
+    (mirror / 'assy_test.nc').write_bytes(content)
+    return mirror, hashlib.sha1(content).hexdigest()
+
+
+@pytest.fixture
+def http_server(mirror):
+    directory, _ = mirror
+    handler = partial(http.server.SimpleHTTPRequestHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+class TestFetchers:
+    def test_local(self, local_data_path, mirror):
+        directory, sha1 = mirror
+        local_path = fetch.fetch_file('file', (directory / 'assy_test.nc').as_uri(), sha1)
+        assert Path(local_path).parent == local_data_path / f"assy_test_{sha1[:12]}"
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+
+    def test_http(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+
+    def test_http_invalid_sha1(self, local_data_path, mirror, http_server):
+        with pytest.raises(IOError):
+            fetch.fetch_file('http', f"{http_server}/assy_test.nc", '0' * 40)
+        assert not os.listdir(local_data_path / f"assy_test_{'0' * 12}")
+
+    def test_register(self, local_data_path, mirror, monkeypatch):
+        directory, sha1 = mirror
+        monkeypatch.setattr(fetch, '_fetcher_types', dict(fetch._fetcher_types))
+        fetch.register_fetcher('lustre', fetch.LocalFetcher)
+        local_path = fetch.fetch_file('lustre', str(directory / 'assy_test.nc'), sha1)
+        assert os.path.isfile(local_path)
+
+    def test_unknown_location_type(self, local_data_path):
+        with pytest.raises(ValueError):
+            fetch.fetch_file('ftp', 'ftp://brainio/assy_test.nc', '0' * 40)
+
+
+def test_bucket_redirect(local_data_path, mirror, monkeypatch):
+    directory, sha1 = mirror
+    monkeypatch.setattr(fetch, 'bucket_redirects', {'brainio-test': directory.as_uri()})
+    local_path = fetch.fetch_file('S3', 'https://brainio-test.s3.amazonaws.com/assy_test.nc', sha1)
+    assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+    assert Path(local_path).parent == local_data_path / f"assy_test_{sha1[:12]}"
+
+
+def test_fetches_metadata_sidecar(local_data_path, mirror):
+    from brainio_collection.metadata_sidecar import read_metadata, write_sidecar_file
+    directory, _ = mirror
+    (directory / 'image_test.csv').write_text("image_id,filename,code\n1,1.png,01\n")
+    csv_sha1 = fetch.sha1_hash(directory / 'image_test.csv')
+    write_sidecar_file(pd.DataFrame({'image_id': ['1'], 'filename': ['1.png'], 'code': ['01']}),
+                       str(directory / 'image_test.feather'), csv_sha1)
+    csv_lookup = {'location_type': 'file', 'location': (directory / 'image_test.csv').as_uri(), 'sha1': csv_sha1}
+    csv_path = fetch.fetch_file(csv_lookup['location_type'], csv_lookup['location'], csv_sha1)
+    fetch.fetch_metadata_sidecar(csv_lookup, csv_path)
+    assert list(read_metadata(csv_path, csv_sha1=csv_sha1)['code']) == ['01']
+
+
+def test_missing_metadata_sidecar(local_data_path, mirror):
+    directory, _ = mirror
+    (directory / 'image_test.csv').write_text("image_id,filename\n1,1.png\n")
+    csv_sha1 = fetch.sha1_hash(directory / 'image_test.csv')
+    csv_lookup = {'location_type': 'file', 'location': (directory / 'image_test.csv').as_uri(), 'sha1': csv_sha1}
+    csv_path = fetch.fetch_file(csv_lookup['location_type'], csv_lookup['location'], csv_sha1)
+    fetch.fetch_metadata_sidecar(csv_lookup, csv_path)  # packaged without a sidecar: the csv file is used
+    assert not os.path.lexists(os.path.splitext(csv_path)[0] + '.feather')
+
+
+class TestMirrors:
+    def test_falls_back_in_order(self, local_data_path, mirror, tmp_path, monkeypatch):
+        directory, sha1 = mirror
+        corrupt_mirror = tmp_path / 'corrupt' / 'brainio-test'
+        corrupt_mirror.mkdir(parents=True)
+        (corrupt_mirror / 'assy_test.nc').write_bytes(b'corrupt')
+        monkeypatch.setattr(fetch, 'mirrors', [(tmp_path / 'missing').as_uri(), (tmp_path / 'corrupt').as_uri(),
+                                               directory.parent.as_uri()])
+        local_path = fetch.fetch_file('S3', 'https://brainio-test.s3.amazonaws.com/assy_test.nc', sha1)
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+
+    def test_candidates(self, monkeypatch):
+        monkeypatch.setattr(fetch, 'mirrors', ['file:///datasets/brainio', 's3+http://object-store.local:9000'])
+        monkeypatch.setattr(fetch, 'bucket_redirects', {'brainio-test': 'https://cache.local/brainio-test'})
+        location = 'https://brainio-test.s3.amazonaws.com/assy_test.nc'
+        assert fetch.candidate_locations('S3', location) == [
+            ('http', 'https://cache.local/brainio-test/assy_test.nc'),
+            ('file', 'file:///datasets/brainio/brainio-test/assy_test.nc'),
+            ('S3', 's3+http://object-store.local:9000/brainio-test/assy_test.nc'),
+            ('S3', location)]
+
+    def test_s3_compatible_location(self):
+        location = 's3+http://s3.object-store.local:9000/brainio-test/assy_test.nc'
+        assert fetch.parse_s3_location(location) == ('brainio-test', 'assy_test.nc')
+        assert fetch.s3_endpoint_url(location) == 'http://s3.object-store.local:9000'
+        assert fetch.s3_endpoint_url('https://brainio-test.s3.amazonaws.com/assy_test.nc') is None
+
+
+class TestBlobStore:
+    def test_duplicate_downloads_once(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        assert os.path.samefile(local_path, fetch.blob_path(sha1))
+        # the same bytes under another key are not on the server, so they can only come from the blob store
+        renamed_path = fetch.fetch_file('http', f"{http_server}/assy_test_renamed.nc", sha1)
+        assert Path(renamed_path).parent == local_data_path / f"assy_test_renamed_{sha1[:12]}"
+        assert os.path.samefile(renamed_path, local_path)
+        assert Path(renamed_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+
+    def test_colliding_basename(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        other_content = os.urandom(2 ** 10)
+        (directory / 'other').mkdir()
+        (directory / 'other' / 'assy_test.nc').write_bytes(other_content)
+        other_sha1 = hashlib.sha1(other_content).hexdigest()
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        other_path = fetch.fetch_file('http', f"{http_server}/other/assy_test.nc", other_sha1)
+        assert Path(local_path).parent != Path(other_path).parent
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+        assert Path(other_path).read_bytes() == other_content
+
+    def test_adopts_legacy_directory(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        legacy_directory = local_data_path / 'assy_legacy'  # named without the hash prefix
+        legacy_directory.mkdir(parents=True)
+        (legacy_directory / 'assy_legacy.nc').write_bytes((directory / 'assy_test.nc').read_bytes())
+        # not on the server, so it can only be adopted from the legacy directory
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_legacy.nc", sha1)
+        assert Path(local_path).parent == local_data_path / f"assy_legacy_{sha1[:12]}"
+        assert os.path.samefile(local_path, legacy_directory / 'assy_legacy.nc')
+        assert os.path.samefile(local_path, fetch.blob_path(sha1))
+
+    def test_ignores_different_legacy_file(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        legacy_directory = local_data_path / 'assy_test'
+        legacy_directory.mkdir(parents=True)
+        (legacy_directory / 'assy_test.nc').write_bytes(b'other')
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+
+    def test_corrupt_blob_is_replaced(self, local_data_path, mirror, http_server):
+        directory, sha1 = mirror
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        with open(fetch.blob_path(sha1), 'r+b') as f:
+            f.write(b'corrupt')
+        local_path = fetch.fetch_file('http', f"{http_server}/assy_test.nc", sha1)
+        assert Path(local_path).read_bytes() == (directory / 'assy_test.nc').read_bytes()
+        assert os.path.samefile(local_path, fetch.blob_path(sha1))
@@ -1,3 +1,12 @@
+import subprocess
+import sys
+
+
 def test_import_brainio_collection():
     # noinspection PyUnresolvedReferences
-    from brainio_collection.packaging import package_stimulus_set, package_data_assembly
\ No newline at end of file
+    from brainio_collection.packaging import package_stimulus_set, package_data_assembly
+
+
+def test_import_does_not_load_pandas():
+    code = "import sys, brainio_collection; brainio_collection.list_assemblies(); assert 'pandas' not in sys.modules"
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -0,0 +1,43 @@
+import json
+import multiprocessing
+
+import pytest
+
+from brainio_collection.locking import FileLock, LockTimeout
+
+
+def _increment(lock_path, counter_path, repetitions):
+    for _ in range(repetitions):
+        with FileLock(lock_path, poll_seconds=0.001):
+            with open(counter_path) as f:
+                value = int(f.read())
+            with open(counter_path, 'w') as f:
+                f.write(str(value + 1))
+
+
+class TestFileLock:
+    def test_exclusive_across_processes(self, tmp_path):
+        lock_path, counter_path = str(tmp_path / 'locks' / 'counter.lock'), tmp_path / 'counter'
+        counter_path.write_text('0')
+        processes = [multiprocessing.Process(target=_increment, args=(lock_path, str(counter_path), 20))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert counter_path.read_text() == '80'
+        assert not (tmp_path / 'locks' / 'counter.lock').exists()
+
+    def test_timeout_while_held(self, tmp_path):
+        lock_path = str(tmp_path / 'held.lock')
+        with FileLock(lock_path, lease_seconds=0.2):
+            with pytest.raises(LockTimeout):
+                # the holder keeps renewing its lease, so the lock is never considered stale
+                FileLock(lock_path, lease_seconds=0.2, poll_seconds=0.01, timeout=0.6).acquire()
+
+    def test_breaks_stale_lock(self, tmp_path):
+        lock_path = tmp_path / 'stale.lock'
+        lock_path.write_text(json.dumps({'token': 'crashed', 'host': 'elsewhere', 'pid': -1}))
+        with FileLock(str(lock_path), lease_seconds=0.1, poll_seconds=0.01, timeout=5):
+            assert json.loads(lock_path.read_text())['token'] != 'crashed'
+        assert not lock_path.exists()
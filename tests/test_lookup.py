@@ -0,0 +1,108 @@
+import multiprocessing
+import shutil
+
+import pytest
+
+from brainio_collection import lookup
+from brainio_collection.lookup import Catalog
+
+
+def _row(identifier, **kwargs):
+    return dict({'identifier': identifier, 'lookup_type': lookup.TYPE_ASSEMBLY, 'class': 'NeuronRecordingAssembly',
+                 'location_type': 'S3', 'location': f"https://brainio.s3.amazonaws.com/{identifier}.nc",
+                 'sha1': '0' * 40, 'stimulus_set_identifier': 'dicarlo.hvm'}, **kwargs)
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / 'lookup.csv'
+    shutil.copy(lookup.path, path)
+    return path
+
+
+def _add_rows(csv_path, worker, num_rows):
+    catalog = Catalog(csv_path)
+    for number in range(num_rows):
+        catalog.add(_row(f"worker{worker}.{number}"))
+
+
+class TestCatalog:
+    def test_add_appends_to_journal(self, csv_path):
+        csv_content = csv_path.read_bytes()
+        catalog = Catalog(csv_path)
+        num_rows = len(catalog.rows())
+        catalog.add(_row('test.new'))
+        assert csv_path.read_bytes() == csv_content
+        assert len(catalog.rows()) == num_rows + 1
+        assert Catalog(csv_path).get('test.new', lookup.TYPE_ASSEMBLY) == [_row('test.new')]
+
+    def test_sees_rows_of_other_writers(self, csv_path):
+        catalog, other_catalog = Catalog(csv_path), Catalog(csv_path)
+        catalog.rows()
+        other_catalog.add(_row('test.other'))
+
+        def validate(current_catalog):
+            assert len(current_catalog.get('test.other', lookup.TYPE_ASSEMBLY)) == 1
+
+        catalog.add(_row('test.mine'), validate=validate)
+        assert len(catalog.get('test.other', lookup.TYPE_ASSEMBLY)) == 1
+
+    def test_validate_rejects(self, csv_path):
+        catalog = Catalog(csv_path)
+
+        def reject(_):
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            catalog.add(_row('test.rejected'), validate=reject)
+        assert Catalog(csv_path).get('test.rejected', lookup.TYPE_ASSEMBLY) == []
+
+    def test_concurrent_writers(self, csv_path):
+        num_rows = len(Catalog(csv_path).rows())
+        processes = [multiprocessing.Process(target=_add_rows, args=(csv_path, worker, 20)) for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert all(process.exitcode == 0 for process in processes)
+        assert len(Catalog(csv_path).rows()) == num_rows + 4 * 20
+
+    def test_torn_line(self, csv_path):
+        catalog = Catalog(csv_path)
+        num_rows = len(catalog.rows())
+        with open(catalog.journal_path, 'ab') as f:
+            f.write(b'{"identifier": "test.to')
+        assert len(Catalog(csv_path).rows()) == num_rows
+        catalog.add(_row('test.after'))
+        assert len(Catalog(csv_path).rows()) == num_rows + 1
+
+    def test_compact(self, csv_path):
+        catalog = Catalog(csv_path)
+        catalog.add(_row('test.compacted'))
+        rows = list(catalog.rows())
+        catalog.compact()
+        assert catalog.journal_path.read_bytes() == b''
+        assert Catalog(csv_path).rows() == rows
+        # a catalog that read the journal before compaction picks up later rows
+        Catalog(csv_path).add(_row('test.after'))
+        assert len(catalog.get('test.after', lookup.TYPE_ASSEMBLY)) == 0
+        catalog.add(_row('test.mine'))
+        assert len(catalog.rows()) == len(rows) + 2
+
+    def test_interrupted_compaction_does_not_duplicate(self, csv_path):
+        catalog = Catalog(csv_path)
+        catalog.add(_row('test.compacted'))
+        catalog.export(csv_path)  # the journal still holds the row
+        assert len(Catalog(csv_path).get('test.compacted', lookup.TYPE_ASSEMBLY)) == 1
+
+    def test_export_round_trip(self, csv_path, tmp_path):
+        export_path = tmp_path / 'export.csv'
+        Catalog(csv_path).export(export_path)
+        assert export_path.read_text().rstrip('\n') == csv_path.read_text().rstrip('\n')
+
+
+def test_cli_export(tmp_path):
+    from brainio_collection.cli import main
+    export_path = tmp_path / 'export.csv'
+    main(['lookup', 'export', str(export_path)])
+    assert export_path.read_text().rstrip('\n') == lookup.path.read_text().rstrip('\n')
@@ -1,3 +1,5 @@
+import zipfile
+
 import pytest
 from pathlib import Path
 
@@ -5,7 +7,10 @@ from pandas import DataFrame
 
 from brainio_base.assemblies import DataAssembly, get_levels
 from brainio_base.stimuli import StimulusSet
-from brainio_collection.packaging import write_netcdf, check_image_numbers, check_image_naming_convention
+from brainio_collection.lookup import sha1_hash
+from brainio_collection.metadata_sidecar import read_metadata, sidecar_path
+from brainio_collection.packaging import write_netcdf, check_image_numbers, check_image_naming_convention, \
+    create_image_zip, create_image_csv, create_metadata_sidecar
 
 
 def test_write_netcdf():
@@ -23,6 +28,37 @@ def test_write_netcdf():
     assert netcdf_path.exists()
 
 
+def test_create_image_zip(tmp_path):
+    image_paths = {}
+    for number in range(20):
+        image_paths[f"image_{number}"] = tmp_path / f"image_{number}.png"
+        image_paths[f"image_{number}"].write_bytes(bytes([number]) * (number * 100))
+    stimulus_set = StimulusSet(DataFrame({'image_id': list(image_paths)}))
+    stimulus_set.image_paths = {image_id: str(path) for image_id, path in image_paths.items()}
+    zip_path = tmp_path / 'zip' / 'images.zip'
+    sha1, arcnames = create_image_zip(stimulus_set, str(zip_path), max_workers=2)
+    assert sha1 == sha1_hash(zip_path)
+    assert arcnames == [f"{image_id}.png" for image_id in image_paths]
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == arcnames
+        for image_id, path in image_paths.items():
+            assert zip_file.read(f"{image_id}.png") == path.read_bytes()
+
+
+def test_create_metadata_sidecar(tmp_path):
+    stimulus_set = StimulusSet(DataFrame({'image_id': [1, 2], 'code': ['01', '02'],
+                                          'image_path_within_store': ['a.png', 'b.png']}))
+    stimulus_set['filename'] = ['1.png', '2.png']
+    csv_path = str(tmp_path / 'image_test.csv')
+    csv_sha1 = create_image_csv(stimulus_set, csv_path)
+    assert create_metadata_sidecar(stimulus_set, csv_path, csv_sha1) == sidecar_path(csv_path)
+    metadata = read_metadata(csv_path, csv_sha1=csv_sha1, write_sidecar=False)
+    assert list(metadata['code']) == ['01', '02']  # the csv file would be parsed as integers
+    assert list(metadata['image_id']) == ['1', '2']
+    assert 'image_path_within_store' not in metadata
+
+
 def test_reset_index():
     assy = DataAssembly(
         data=[[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12], [13, 14, 15], [16, 17, 18]],
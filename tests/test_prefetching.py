@@ -0,0 +1,55 @@
+import hashlib
+import os
+import zipfile
+
+import pytest
+
+import brainio_collection
+from brainio_collection import fetch, lookup
+from brainio_collection.lookup import Catalog, COLUMNS
+
+
+@pytest.fixture
+def local_catalog(tmp_path, monkeypatch):
+    """ a catalog of two assemblies sharing one stimulus set, with all files on the local file system """
+    monkeypatch.setattr(fetch, '_local_data_path', str(tmp_path / 'brainio_home'))
+    monkeypatch.setattr(fetch, 'verification_index', fetch.VerificationIndex(str(tmp_path / 'index.json')))
+    source = tmp_path / 'source'
+    source.mkdir()
+
+    def add_file(name, content):
+        (source / name).write_bytes(content)
+        return (source / name).as_uri(), hashlib.sha1(content).hexdigest()
+
+    zip_path = source / 'image_test_stimuli.zip'
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        zip_file.writestr('image1.png', b'image')
+    rows = []
+    for name, identifier, lookup_type, cls, stimulus_set_identifier in [
+        ('assy_test_one.nc', 'test.One', lookup.TYPE_ASSEMBLY, 'NeuronRecordingAssembly', 'test.stimuli'),
+        ('assy_test_two.nc', 'test.Two', lookup.TYPE_ASSEMBLY, 'NeuronRecordingAssembly', 'test.stimuli'),
+        ('image_test_stimuli.csv', 'test.stimuli', lookup.TYPE_STIMULUS_SET, 'StimulusSet', None),
+    ]:
+        location, sha1 = add_file(name, os.urandom(100))
+        rows.append((identifier, lookup_type, cls, location, sha1, stimulus_set_identifier))
+    rows.append(('test.stimuli', lookup.TYPE_STIMULUS_SET, None, zip_path.as_uri(),
+                 hashlib.sha1(zip_path.read_bytes()).hexdigest(), None))
+    csv_path = tmp_path / 'lookup.csv'
+    csv_path.write_text(','.join(COLUMNS) + '\n')
+    catalog = Catalog(csv_path)
+    for identifier, lookup_type, cls, location, sha1, stimulus_set_identifier in rows:
+        catalog.add({'identifier': identifier, 'lookup_type': lookup_type, 'class': cls, 'location_type': 'file',
+                     'location': location, 'sha1': sha1, 'stimulus_set_identifier': stimulus_set_identifier})
+    monkeypatch.setattr(lookup, 'catalog', catalog)
+    return tmp_path / 'brainio_home'
+
+
+def test_prefetch(local_catalog):
+    report = brainio_collection.prefetch(['test.One', 'test.Two'], max_concurrency=2)
+    assert len(report.paths) == 4  # the shared stimulus set is only fetched once
+    assert report.num_files_fetched == 4
+    assert all(os.path.isfile(path) for path in report.paths.values())
+    zip_path, = [path for path in report.paths.values() if path.endswith('.zip')]
+    assert os.path.isfile(os.path.join(os.path.dirname(zip_path), 'image1.png'))
+    report = brainio_collection.prefetch(['test.One', 'test.stimuli'])
+    assert report.num_files_fetched == 0
@@ -1,9 +1,16 @@
 import imageio
 import numpy as np
 import os
+import pandas as pd
 import pytest
+import zipfile
 
 import brainio_collection
+from brainio_collection.image_paths import ImagePaths
+from brainio_collection.lookup import sha1_hash
+from brainio_collection.metadata_sidecar import read_metadata, sidecar_path
+from brainio_collection.fetch import unzip, extraction_manifest_path, read_extraction_manifest
+from brainio_collection.zip_store import ZipImageStore
 
 
 def test_get_stimulus_set():
@@ -22,6 +29,15 @@ def test_get_stimulus_set():
         assert extension in ['.png', '.PNG', '.jpg', '.jpeg', '.JPG', '.JPEG']
 
 
+def test_get_stimulus_set_without_extraction():
+    stimulus_set = brainio_collection.get_stimulus_set("dicarlo.hvm-public", extract=False)
+    assert len(stimulus_set) == 3200
+    assert stimulus_set.identifier == 'dicarlo.hvm-public'
+    image = imageio.imread(stimulus_set.get_image(stimulus_set['image_id'].values[0]))
+    assert isinstance(image, np.ndarray)
+    assert image.size > 0
+
+
 def test_loadname_dicarlo_hvm():
     assert brainio_collection.get_stimulus_set(identifier="dicarlo.hvm-public") is not None
 
@@ -131,3 +147,125 @@ class TestMarques2020V1Properties:
     def test_num_stimuli(self, identifier, num_stimuli):
         stimulus_set = brainio_collection.get_stimulus_set(identifier)
         assert len(stimulus_set) == num_stimuli
+
+
+class TestUnzip:
+    @pytest.fixture
+    def zip_path(self, tmp_path):
+        zip_path = tmp_path / 'images.zip'
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            for number in range(10):
+                zip_file.writestr(f"images/image_{number}.png", bytes([number]) * (number + 1) * 100)
+        return str(zip_path)
+
+    def test_extracts_all(self, zip_path):
+        directory = unzip(zip_path, max_workers=4)
+        with zipfile.ZipFile(zip_path) as zip_file:
+            for name in zip_file.namelist():
+                with open(os.path.join(directory, name), 'rb') as f:
+                    assert f.read() == zip_file.read(name)
+        manifest = read_extraction_manifest(zip_path)
+        assert manifest['members'] == {f"images/image_{number}.png": (number + 1) * 100 for number in range(10)}
+
+    def test_manifest_skips_extraction(self, zip_path):
+        directory = unzip(zip_path)
+        os.remove(os.path.join(directory, 'images', 'image_3.png'))
+        unzip(zip_path)
+        assert not os.path.exists(os.path.join(directory, 'images', 'image_3.png'))
+
+    def test_deep_verify(self, zip_path):
+        directory = unzip(zip_path)
+        os.remove(os.path.join(directory, 'images', 'image_3.png'))
+        unzip(zip_path, deep_verify=True)
+        assert os.path.isfile(os.path.join(directory, 'images', 'image_3.png'))
+
+    def test_changed_zip_invalidates_manifest(self, zip_path):
+        unzip(zip_path)
+        with zipfile.ZipFile(zip_path, 'a') as zip_file:
+            zip_file.writestr('images/image_10.png', b'new')
+        assert read_extraction_manifest(zip_path) is None
+        unzip(zip_path)
+        assert 'images/image_10.png' in read_extraction_manifest(zip_path)['members']
+
+    def test_extracts_only_missing_and_mismatched(self, zip_path):
+        directory = unzip(zip_path)
+        os.remove(extraction_manifest_path(zip_path))
+        os.remove(os.path.join(directory, 'images', 'image_3.png'))
+        with open(os.path.join(directory, 'images', 'image_4.png'), 'wb') as f:
+            f.write(b'truncated')
+        untouched_mtime = os.stat(os.path.join(directory, 'images', 'image_5.png')).st_mtime_ns
+        unzip(zip_path)
+        with zipfile.ZipFile(zip_path) as zip_file:
+            for number in (3, 4):
+                with open(os.path.join(directory, 'images', f"image_{number}.png"), 'rb') as f:
+                    assert f.read() == zip_file.read(f"images/image_{number}.png")
+        assert os.stat(os.path.join(directory, 'images', 'image_5.png')).st_mtime_ns == untouched_mtime
+
+
+class TestZipImageStore:
+    def test_read(self, tmp_path):
+        zip_path = tmp_path / 'images.zip'
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            zip_file.writestr('images/stored.png', b'stored' * 100, compress_type=zipfile.ZIP_STORED)
+            zip_file.writestr('deflated.png', b'deflated' * 100, compress_type=zipfile.ZIP_DEFLATED)
+        store = ZipImageStore(str(zip_path))
+        assert len(store) == 2
+        assert 'images/stored.png' in store
+        assert store.read('images/stored.png') == b'stored' * 100
+        assert store.open('deflated.png').read() == b'deflated' * 100
+        with pytest.raises(KeyError):
+            store.read('missing.png')
+
+
+class TestImagePaths:
+    def test_lookup(self):
+        image_paths = ImagePaths(['a', 'b', 'c'], ['a.png', 'sub/b.png', 'c.jpg'], prefix='/stimuli/')
+        assert image_paths['b'] == '/stimuli/sub/b.png'
+        assert len(image_paths) == 3
+        assert list(image_paths) == ['a', 'b', 'c']
+        assert 'c' in image_paths and 'd' not in image_paths
+        with pytest.raises(KeyError):
+            image_paths['d']
+
+    def test_equals_dict(self):
+        image_ids, filenames = ['a', 'b', 'a'], ['a1.png', 'b.png', 'a2.png']
+        image_paths = ImagePaths(image_ids, filenames, prefix='/stimuli/')
+        assert image_paths == {image_id: '/stimuli/' + filename for image_id, filename in zip(image_ids, filenames)}
+        assert list(image_paths.paths()) == ['/stimuli/b.png', '/stimuli/a2.png']
+
+
+class TestMetadataSidecar:
+    @pytest.fixture
+    def csv_path(self, tmp_path):
+        csv_path = str(tmp_path / 'stimuli.csv')
+        pd.DataFrame({'image_id': [f"image{number}" for number in range(10)],
+                      'filename': [f"image{number}.png" for number in range(10)],
+                      'category_name': ['car', 'face'] * 5,
+                      'size': np.arange(10) / 10}).to_csv(csv_path, index=False)
+        return csv_path
+
+    def test_writes_and_prefers_sidecar(self, csv_path):
+        csv_sha1 = sha1_hash(csv_path)
+        from_csv = read_metadata(csv_path, csv_sha1=csv_sha1)
+        assert os.path.isfile(sidecar_path(csv_path))
+        from_sidecar = read_metadata(csv_path, csv_sha1=csv_sha1)
+        assert isinstance(from_sidecar['category_name'].dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(from_sidecar, from_csv)
+
+    def test_numeric_image_ids_are_strings(self, tmp_path):
+        csv_path = str(tmp_path / 'stimuli.csv')
+        pd.DataFrame({'image_id': [1, 2], 'filename': ['1.png', '2.png']}).to_csv(csv_path, index=False)
+        csv_sha1 = sha1_hash(csv_path)
+        for _ in range(2):  # from the csv file, then from the sidecar
+            metadata = read_metadata(csv_path, csv_sha1=csv_sha1)
+            assert list(metadata['image_id']) == ['1', '2']
+
+    def test_ignores_outdated_sidecar(self, csv_path):
+        read_metadata(csv_path, csv_sha1=sha1_hash(csv_path))
+        pd.DataFrame({'image_id': ['other'], 'filename': ['other.png']}).to_csv(csv_path, index=False)
+        metadata = read_metadata(csv_path, csv_sha1=sha1_hash(csv_path))
+        assert list(metadata['image_id']) == ['other']
+
+    def test_without_hash_reads_csv(self, csv_path):
+        read_metadata(csv_path)
+        assert not os.path.exists(sidecar_path(csv_path))
@@ -1,10 +1,11 @@
 import numpy as np
 import pytest
 import xarray as xr
+from hypothesis import given, strategies as st
 from brainio_collection import get_assembly
 
 from brainio_base.assemblies import NeuroidAssembly
-from brainio_collection.transform import subset, index_efficient
+from brainio_collection.transform import subset, index_efficient, index_isin
 
 
 class TestSubset:
@@ -160,3 +161,98 @@ class TestIndexEfficient:
         indexer = [index for index in indexer if index != -1]
         result = index_efficient(a, b)
         assert result == indexer
+
+
+class TestSubsetJointLevels:
+    def assembly(self, image_ids, repetitions):
+        return NeuroidAssembly(np.arange(len(image_ids))[:, np.newaxis], coords={
+            'image_id': ('presentation', image_ids),
+            'repetition': ('presentation', repetitions),
+            'neuroid_id': ('neuroid', [0])},
+                               dims=['presentation', 'neuroid'])
+
+    def test_jointly_unique(self):
+        source_assembly = self.assembly(['a', 'a', 'b', 'b'], [1, 2, 1, 2])
+        target_assembly = self.assembly(['a', 'b'], [1, 2])
+        per_level = subset(source_assembly, target_assembly, subset_dims=('presentation',), dims_must_match=False)
+        assert len(per_level['presentation']) == 4
+        joint = subset(source_assembly, target_assembly, subset_dims=('presentation',), joint_levels=True)
+        np.testing.assert_array_equal(joint.values.squeeze(), [0, 3])
+
+    def test_repeat(self):
+        source_assembly = self.assembly(['a', 'a', 'b', 'b'], [1, 2, 1, 2])
+        target_assembly = self.assembly(['b', 'a', 'a'], [2, 1, 1])
+        joint = subset(source_assembly, target_assembly, subset_dims=('presentation',), joint_levels=True,
+                       repeat=True)
+        np.testing.assert_array_equal(joint.values.squeeze(), [0, 0, 3])
+
+    def test_missing_values_match_nothing(self):
+        source_assembly = self.assembly(['a', 'a', 'b'], [1, np.nan, np.nan])
+        target_assembly = self.assembly(['a', 'a', 'b'], [1, np.nan, np.nan])
+        joint = subset(source_assembly, target_assembly, subset_dims=('presentation',), joint_levels=True,
+                       dims_must_match=False)
+        np.testing.assert_array_equal(joint.values.squeeze(), [0])
+
+
+def index_efficient_reference(source_values, target_values):
+    """ previous, loop-based implementation of `index_efficient` """
+    source_sort_indices, target_sort_indices = np.argsort(source_values), np.argsort(target_values)
+    source_values, target_values = source_values[source_sort_indices], target_values[target_sort_indices]
+    indexer = []
+    source_index, target_index = 0, 0
+    while target_index < len(target_values) and source_index < len(source_values):
+        if source_values[source_index] == target_values[target_index]:
+            indexer.append(source_sort_indices[source_index])
+            # if next source value is greater than target, use next target. else next source.
+            # if target values remain the same, we might as well take the next target.
+            if (target_index + 1 < len(target_values) and
+                target_values[target_index + 1] == target_values[target_index]) or \
+                    (source_index + 1 < len(source_values) and
+                     source_values[source_index + 1] > target_values[target_index]):
+                target_index += 1
+            else:
+                source_index += 1
+        elif source_values[source_index] < target_values[target_index]:
+            source_index += 1
+        else:  # source_values[source_index] > target_values[target_index]:
+            target_index += 1
+    return indexer
+
+
+class TestIndexEfficientProperties:
+    @given(st.lists(st.integers(0, 10), max_size=50), st.lists(st.integers(0, 10), max_size=50))
+    def test_integers(self, source_values, target_values):
+        source_values, target_values = np.array(source_values, dtype=int), np.array(target_values, dtype=int)
+        assert index_efficient(source_values, target_values) == \
+               index_efficient_reference(source_values, target_values)
+
+    @given(st.lists(st.one_of(st.integers(0, 10).map(float), st.just(np.nan)), max_size=50),
+           st.lists(st.one_of(st.integers(0, 10).map(float), st.just(np.nan)), max_size=50))
+    def test_floats_with_nan(self, source_values, target_values):
+        source_values, target_values = np.array(source_values, dtype=float), np.array(target_values, dtype=float)
+        assert index_efficient(source_values, target_values) == \
+               index_efficient_reference(source_values, target_values)
+
+    @given(st.lists(st.sampled_from(['a', 'b', 'c', 'd']), max_size=50),
+           st.lists(st.sampled_from(['a', 'b', 'c', 'e']), max_size=50))
+    def test_strings(self, source_values, target_values):
+        source_values, target_values = np.array(source_values, dtype=object), np.array(target_values, dtype=object)
+        assert index_efficient(source_values, target_values) == \
+               index_efficient_reference(source_values, target_values)
+
+
+class TestIndexIsin:
+    @pytest.mark.parametrize('source_values, target_values', [
+        (np.array([1, 2, 3, 4, 5, 1]), np.array([1, 4, 7])),
+        (np.array(['a', 'b', 'c', 'a']), np.array(['a', 'z'])),
+        (np.array([1., np.nan, 3.]), np.array([np.nan, 3.])),
+        (np.random.RandomState(0).randint(0, 50, 1000), np.random.RandomState(1).randint(0, 50, 30)),
+    ])
+    def test_matches_membership_loop(self, source_values, target_values):
+        expected = np.where(np.array([val in target_values for val in source_values]))[0]
+        np.testing.assert_array_equal(index_isin(source_values, target_values), expected)
+
+    def test_object_missing_values_match_nothing(self):
+        source_values = np.array(['a', np.nan, 'b', None], dtype=object)
+        target_values = np.array([np.nan, 'b', None], dtype=object)
+        np.testing.assert_array_equal(index_isin(source_values, target_values), [2])